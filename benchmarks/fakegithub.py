@@ -0,0 +1,181 @@
+"""A local HTTP server answering the Github API calls made during ingest
+
+Repos are synthesised deterministically from their name so every run
+serves identical content.
+"""
+import asyncio
+import base64
+import hashlib
+import io
+import tarfile
+
+import yaml
+from aiohttp import web
+
+
+def sha(content):
+    """The git blob sha, as reported by the contents and trees APIs"""
+    data = content.encode("utf-8")
+    header = "blob {}\0".format(len(data)).encode("utf-8")
+    return hashlib.sha1(header + data).hexdigest()
+
+
+def encode(content):
+    return base64.b64encode(content.encode("utf-8")).decode("ascii")
+
+
+class SyntheticRepo:
+    def __init__(self, owner, name, rules=2, schemas=3, other=5):
+        self.owner = owner
+        self.name = name
+        self.files = {"README.md": self.readme()}
+        for i in range(rules):
+            self.files["{}-{}.rules".format(name, i)] = self.rules(i)
+        for i in range(schemas):
+            self.files["{}-{}.schema".format(name, i)] = self.schema(i)
+        for i in range(other):
+            self.files["src/module{}.py".format(i)] = "pass\n" * 20
+
+    def readme(self):
+        para = ("The {} layer provides interfaces for benchmarking. "
+                "It is synthesised for load tests.\n").format(self.name)
+        return "# {}\n\n{}".format(self.name, para * 40)
+
+    def rules(self, i):
+        return yaml.safe_dump([
+            {"name": "rule-{}-{}".format(i, j),
+             "when": ["{}.ready".format(self.name)],
+             "do": [{"action": "set", "key": "k{}".format(j)}]}
+            for j in range(20)])
+
+    def schema(self, i):
+        return yaml.safe_dump({
+            "title": "{}-{}".format(self.name, i),
+            "type": "object",
+            "properties": {"field{}".format(j): {"type": "string"}
+                           for j in range(30)}})
+
+
+class FakeGithub:
+    def __init__(self, loop, latency=0.0):
+        self.loop = loop
+        self.latency = latency
+        self.repos = {}
+        self.requests = 0
+        self.app = web.Application(loop=loop)
+        router = self.app.router
+        router.add_route("GET", "/repos/{owner}/{repo}/readme", self.readme)
+        router.add_route("GET", "/repos/{owner}/{repo}/contents",
+                         self.contents)
+        router.add_route("GET", "/repos/{owner}/{repo}/contents/{path:.+}",
+                         self.content)
+        router.add_route("GET", "/repos/{owner}/{repo}/git/trees/{ref}",
+                         self.tree)
+        router.add_route("GET", "/repos/{owner}/{repo}/git/blobs/{sha}",
+                         self.blob)
+        router.add_route("GET", "/repos/{owner}/{repo}/tarball",
+                         self.tarball)
+
+    def add_repo(self, owner, name, **kwargs):
+        repo = SyntheticRepo(owner, name, **kwargs)
+        self.repos[(owner, name)] = repo
+        return repo
+
+    async def start(self, host="127.0.0.1", port=0):
+        self.handler = self.app.make_handler()
+        self.server = await self.loop.create_server(self.handler, host, port)
+        port = self.server.sockets[0].getsockname()[1]
+        self.url = "http://{}:{}".format(host, port)
+        return self.url
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+        await self.handler.finish_connections()
+
+    async def lookup(self, request):
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        key = (request.match_info["owner"], request.match_info["repo"])
+        if key not in self.repos:
+            raise web.HTTPNotFound()
+        return self.repos[key]
+
+    def file_entry(self, repo, path):
+        content = repo.files[path]
+        return {"type": "file",
+                "name": path.rsplit("/", 1)[-1],
+                "path": path,
+                "sha": sha(content),
+                "size": len(content),
+                "url": "{}/repos/{}/{}/contents/{}".format(
+                    self.url, repo.owner, repo.name, path)}
+
+    async def readme(self, request):
+        repo = await self.lookup(request)
+        entry = self.file_entry(repo, "README.md")
+        entry.update(content=encode(repo.files["README.md"]),
+                     encoding="base64")
+        return web.json_response(entry)
+
+    async def contents(self, request):
+        repo = await self.lookup(request)
+        listing = []
+        dirs = set()
+        for path in sorted(repo.files):
+            if "/" in path:
+                dirs.add(path.split("/", 1)[0])
+            else:
+                listing.append(self.file_entry(repo, path))
+        for d in sorted(dirs):
+            listing.append({"type": "dir", "name": d, "path": d})
+        return web.json_response(listing)
+
+    async def content(self, request):
+        repo = await self.lookup(request)
+        path = request.match_info["path"]
+        if path not in repo.files:
+            raise web.HTTPNotFound()
+        entry = self.file_entry(repo, path)
+        entry.update(content=encode(repo.files[path]), encoding="base64")
+        return web.json_response(entry)
+
+    async def tree(self, request):
+        repo = await self.lookup(request)
+        entries = []
+        dirs = set()
+        for path in sorted(repo.files):
+            if "/" in path:
+                dirs.add(path.rsplit("/", 1)[0])
+            entries.append({"type": "blob", "mode": "100644",
+                            "path": path, "sha": sha(repo.files[path]),
+                            "size": len(repo.files[path])})
+        for d in sorted(dirs):
+            entries.append({"type": "tree", "mode": "040000", "path": d})
+        return web.json_response({"sha": "HEAD", "tree": entries,
+                                  "truncated": False})
+
+    async def blob(self, request):
+        repo = await self.lookup(request)
+        wanted = request.match_info["sha"]
+        for content in repo.files.values():
+            if sha(content) == wanted:
+                return web.json_response({"sha": wanted,
+                                          "size": len(content),
+                                          "encoding": "base64",
+                                          "content": encode(content)})
+        raise web.HTTPNotFound()
+
+    async def tarball(self, request):
+        repo = await self.lookup(request)
+        buf = io.BytesIO()
+        prefix = "{}-{}-0000000".format(repo.owner, repo.name)
+        with tarfile.open(fileobj=buf, mode="w:gz") as archive:
+            for path, content in sorted(repo.files.items()):
+                data = content.encode("utf-8")
+                info = tarfile.TarInfo("{}/{}".format(prefix, path))
+                info.size = len(data)
+                archive.addfile(info, io.BytesIO(data))
+        return web.Response(body=buf.getvalue(),
+                            content_type="application/x-gzip")
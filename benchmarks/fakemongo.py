@@ -0,0 +1,383 @@
+"""In process stand-in for the subset of Motor used by layersite
+
+This keeps benchmarks reproducible and independent of a Mongo server. It
+is not a general purpose Mongo emulator: only the query and update
+operators the site actually issues are implemented, and every operation
+completes without yielding to the loop beyond a single await.
+"""
+import copy
+import datetime
+import re
+
+from bson import ObjectId
+
+
+MISSING = object()
+
+
+def get_path(doc, path):
+    value = doc
+    for part in path.split("."):
+        if isinstance(value, dict) and part in value:
+            value = value[part]
+        elif isinstance(value, list) and part.isdigit() and \
+                int(part) < len(value):
+            value = value[int(part)]
+        else:
+            return MISSING
+    return value
+
+
+def set_path(doc, path, value):
+    parts = path.split(".")
+    for part in parts[:-1]:
+        doc = doc.setdefault(part, {})
+    doc[parts[-1]] = value
+
+
+def unset_path(doc, path):
+    parts = path.split(".")
+    for part in parts[:-1]:
+        doc = doc.get(part)
+        if not isinstance(doc, dict):
+            return
+    doc.pop(parts[-1], None)
+
+
+TYPE_NAMES = {
+    "string": str,
+    "date": datetime.datetime,
+    "number": (int, float),
+    "object": dict,
+    "array": list,
+}
+
+
+def _compare(value, op, arg):
+    if op == "$eq":
+        return value == arg if value is not MISSING else arg is None
+    if op == "$ne":
+        return value != arg
+    if op == "$in":
+        if value is MISSING:
+            return None in arg
+        if isinstance(value, list):
+            return any(v in arg for v in value)
+        return value in arg
+    if op == "$nin":
+        return value not in arg
+    if op == "$exists":
+        return (value is not MISSING) == bool(arg)
+    if op == "$type":
+        return value is not MISSING and isinstance(value, TYPE_NAMES[arg])
+    if value is MISSING or value is None:
+        return False
+    try:
+        if op == "$gt":
+            return value > arg
+        if op == "$gte":
+            return value >= arg
+        if op == "$lt":
+            return value < arg
+        if op == "$lte":
+            return value <= arg
+    except TypeError:
+        return False
+    raise NotImplementedError("Unsupported query operator {}".format(op))
+
+
+def _text_match(doc, search):
+    terms = [t.lower() for t in search.split()]
+
+    def strings(value):
+        if isinstance(value, str):
+            yield value.lower()
+        elif isinstance(value, dict):
+            for v in value.values():
+                yield from strings(v)
+        elif isinstance(value, list):
+            for v in value:
+                yield from strings(v)
+
+    text = " ".join(strings(doc))
+    return any(term in text for term in terms)
+
+
+def matches(doc, query):
+    for key, cond in query.items():
+        if key == "$query":
+            if not matches(doc, cond):
+                return False
+        elif key == "$text":
+            if not _text_match(doc, cond["$search"]):
+                return False
+        elif key == "$or":
+            if not any(matches(doc, q) for q in cond):
+                return False
+        elif key == "$and":
+            if not all(matches(doc, q) for q in cond):
+                return False
+        else:
+            value = get_path(doc, key)
+            if isinstance(cond, dict) and cond and \
+                    all(k.startswith("$") for k in cond):
+                if "$regex" in cond:
+                    flags = re.I if "i" in cond.get("$options", "") else 0
+                    if not (isinstance(value, str) and
+                            re.search(cond["$regex"], value, flags)):
+                        return False
+                    cond = {k: v for k, v in cond.items()
+                            if k not in ("$regex", "$options")}
+                if not all(_compare(value, op, arg)
+                           for op, arg in cond.items()):
+                    return False
+            elif isinstance(value, list) and not isinstance(cond, list):
+                if cond not in value:
+                    return False
+            elif (value if value is not MISSING else None) != cond:
+                return False
+    return True
+
+
+def project(doc, projection):
+    if not projection:
+        return doc
+    include = {k for k, v in projection.items() if v and k != "_id"}
+    if include:
+        result = {}
+        if projection.get("_id", 1):
+            result["_id"] = doc.get("_id")
+        for key in include:
+            value = get_path(doc, key)
+            if value is not MISSING:
+                set_path(result, key, value)
+        return result
+    result = dict(doc)
+    for key, v in projection.items():
+        if not v:
+            unset_path(result, key)
+    return result
+
+
+def apply_update(doc, update, inserting=False):
+    if not any(k.startswith("$") for k in update):
+        replacement = copy.deepcopy(update)
+        replacement["_id"] = doc.get("_id")
+        doc.clear()
+        doc.update(replacement)
+        return
+    for op, fields in update.items():
+        for path, value in fields.items():
+            if op == "$set":
+                set_path(doc, path, copy.deepcopy(value))
+            elif op == "$setOnInsert":
+                if inserting:
+                    set_path(doc, path, copy.deepcopy(value))
+            elif op == "$unset":
+                unset_path(doc, path)
+            elif op == "$inc":
+                current = get_path(doc, path)
+                set_path(doc, path,
+                         (0 if current is MISSING else current) + value)
+            elif op == "$addToSet":
+                current = get_path(doc, path)
+                if current is MISSING:
+                    current = []
+                    set_path(doc, path, current)
+                if value not in current:
+                    current.append(copy.deepcopy(value))
+            else:
+                raise NotImplementedError(
+                        "Unsupported update operator {}".format(op))
+
+
+def seed_from_query(query):
+    doc = {}
+    for key, value in query.items():
+        if key.startswith("$"):
+            continue
+        if isinstance(value, dict) and any(k.startswith("$") for k in value):
+            if "$eq" in value:
+                set_path(doc, key, value["$eq"])
+            continue
+        set_path(doc, key, copy.deepcopy(value))
+    return doc
+
+
+class FakeCursor:
+    def __init__(self, collection, query, projection=None):
+        self.collection = collection
+        self.query = query or {}
+        self.projection = projection
+        self._sort = []
+        self._limit = 0
+        self._skip = 0
+        self._results = None
+
+    def sort(self, key, direction=1):
+        if isinstance(key, (list, tuple)):
+            self._sort.extend(key)
+        else:
+            self._sort.append((key, direction))
+        return self
+
+    def limit(self, n):
+        self._limit = n
+        return self
+
+    def skip(self, n):
+        self._skip = n
+        return self
+
+    def batch_size(self, n):
+        return self
+
+    def max_time_ms(self, ms):
+        return self
+
+    def _evaluate(self):
+        docs = [d for d in self.collection.docs if matches(d, self.query)]
+        for key, direction in reversed(self._sort):
+            docs.sort(key=lambda d: _sort_key(get_path(d, key)),
+                      reverse=direction < 0)
+        docs = docs[self._skip:]
+        if self._limit:
+            docs = docs[:self._limit]
+        return [project(copy.deepcopy(d), self.projection) for d in docs]
+
+    async def to_list(self, length=None):
+        results = self._evaluate()
+        return results[:length] if length else results
+
+    def __aiter__(self):
+        self._results = iter(self._evaluate())
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self._results)
+        except StopIteration:
+            raise StopAsyncIteration
+
+
+def _sort_key(value):
+    if value is MISSING or value is None:
+        return (0, "")
+    if isinstance(value, (int, float)):
+        return (1, value)
+    if isinstance(value, datetime.datetime):
+        return (2, value.timestamp())
+    return (3, str(value))
+
+
+class FakeCollection:
+    def __init__(self, database, name):
+        self.database = database
+        self.name = name
+        self.docs = []
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self.database[self.name + "." + name]
+
+    async def ensure_index(self, *args, **kwargs):
+        return kwargs.get("name")
+
+    create_index = ensure_index
+
+    async def drop_index(self, name):
+        return None
+
+    def find(self, query=None, projection=None, **kwargs):
+        return FakeCursor(self, query, projection)
+
+    async def find_one(self, query=None, projection=None, **kwargs):
+        async for doc in FakeCursor(self, query, projection).limit(1):
+            return doc
+        return None
+
+    async def count(self, query=None):
+        return len([d for d in self.docs if matches(d, query or {})])
+
+    async def insert(self, doc, **kwargs):
+        if isinstance(doc, list):
+            return [await self.insert(d) for d in doc]
+        doc = copy.deepcopy(doc)
+        doc.setdefault("_id", ObjectId())
+        self.docs.append(doc)
+        return doc["_id"]
+
+    async def update(self, spec, update, upsert=False, multi=False, **kw):
+        n = 0
+        for doc in self.docs:
+            if matches(doc, spec):
+                apply_update(doc, update)
+                n += 1
+                if not multi:
+                    break
+        if n == 0 and upsert:
+            doc = seed_from_query(spec)
+            doc.setdefault("_id", ObjectId())
+            apply_update(doc, update, inserting=True)
+            self.docs.append(doc)
+            return {"n": 1, "updatedExisting": False, "upserted": doc["_id"]}
+        return {"n": n, "updatedExisting": n > 0}
+
+    async def find_one_and_update(self, spec, update, projection=None,
+                                  sort=None, upsert=False,
+                                  return_document=False, **kwargs):
+        cursor = FakeCursor(self, spec)
+        if sort:
+            cursor.sort(sort)
+        candidates = [d for d in cursor._evaluate()]
+        if candidates:
+            target = next(d for d in self.docs
+                          if d["_id"] == candidates[0]["_id"])
+            before = copy.deepcopy(target)
+            apply_update(target, update)
+        elif upsert:
+            target = seed_from_query(spec)
+            target.setdefault("_id", ObjectId())
+            apply_update(target, update, inserting=True)
+            self.docs.append(target)
+            before = None
+        else:
+            return None
+        # ReturnDocument.AFTER is True
+        result = copy.deepcopy(target) if return_document else before
+        return project(result, projection) if result else result
+
+    async def bulk_write(self, requests, ordered=True, **kwargs):
+        # pymongo's request objects keep their arguments in private slots
+        for request in requests:
+            if type(request).__name__ == "InsertOne":
+                await self.insert(request._doc)
+            else:
+                await self.update(request._filter, request._doc,
+                                  upsert=request._upsert,
+                                  multi=type(request).__name__ == "UpdateMany")
+
+    async def remove(self, spec=None, multi=True, **kwargs):
+        before = len(self.docs)
+        self.docs = [d for d in self.docs if not matches(d, spec or {})]
+        return {"n": before - len(self.docs)}
+
+
+class FakeDatabase:
+    def __init__(self, name="layers"):
+        self.name = name
+        self._collections = {}
+
+    def __getitem__(self, name):
+        if name not in self._collections:
+            self._collections[name] = FakeCollection(self, name)
+        return self._collections[name]
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self[name]
+
+    async def command(self, *args, **kwargs):
+        return {"ok": 1}
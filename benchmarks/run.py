@@ -0,0 +1,396 @@
+"""Load test and micro-benchmark suite
+
+Boots the site from layersite.main.init against the in-process Mongo
+stand-in and a local fake Github, seeds N synthetic layers and runs each
+scenario with a fixed number of requests at a fixed concurrency.
+
+    python -m benchmarks.run --layers 200 --output results.json
+    python -m benchmarks.run --compare baseline.json --output new.json
+"""
+import argparse
+import asyncio
+import base64
+import datetime
+import json
+import logging
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+from pathlib import Path
+
+import aiohttp
+
+from layersite import auth
+from layersite import blobs
+from layersite import jobs
+from layersite import main as site
+from layersite import model
+from layersite import stats
+from layersite.api import dump
+
+from .fakegithub import FakeGithub
+from .fakemongo import FakeDatabase
+
+log = logging.getLogger("benchmarks")
+
+ADMIN = {"login": "bench-admin", "name": "Benchmark"}
+
+
+def percentile(samples, pct):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def peak_rss_kb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes, Linux kilobytes
+    return rss // 1024 if sys.platform == "darwin" else rss
+
+
+def user_cookie(user):
+    return base64.b64encode(json.dumps(user).encode("utf-8")).decode("utf-8")
+
+
+def layer_doc(i):
+    return {"id": "layer-{}".format(i),
+            "name": "layer-{}".format(i),
+            "repo": "https://github.com/bench/repo{}".format(i),
+            "summary": "Synthetic layer number {} for load tests".format(i),
+            "owner": [ADMIN["login"]],
+            "version": 1}
+
+
+class Environment:
+    """The site, its stand-in database and fake Github wired together"""
+
+    def __init__(self, loop, options):
+        self.loop = loop
+        self.options = options
+        self.db = FakeDatabase()
+        self.github = FakeGithub(loop, latency=options.github_latency)
+        self.cwd = os.getcwd()
+        self.workdir = None
+
+    async def start(self):
+        workdir = Path(tempfile.mkdtemp(prefix="layersite-bench-"))
+        self.workdir = str(workdir)
+        (workdir / "static").mkdir()
+        (workdir / "bower_components").mkdir()
+        credentials = workdir / "credentials.yaml"
+        credentials.write_text(json.dumps({
+            "github": {"github_id": "bench", "github_secret": "bench"},
+            "site": {"admin_users": [ADMIN["login"]]}}))
+        os.chdir(self.workdir)
+
+        github_url = await self.github.start()
+        auth.GithubAPI.endpoint = github_url
+
+        options = site.setup([
+            "--credentials", str(credentials),
+            "--mongo-db", "bench",
+            "--ingest-workers", str(self.options.ingest_workers),
+            "--ingest-mode", self.options.ingest_mode,
+            # every request comes from one anonymous client
+            "--search-rate", "0",
+            "--search-queue", str(self.options.concurrency)])
+        self.app = await site.init(options, self.loop, db=self.db)
+        # report failures rather than waiting out retry backoff
+        self.app['jobs'].MAX_ATTEMPTS = 1
+        # benchmarks drive sweeps explicitly
+        for task in ("repo_watcher", ):
+            if task in self.app:
+                self.app[task].cancel()
+
+        self.handler = self.app.make_handler(access_log=None)
+        self.server = await self.loop.create_server(
+                self.handler, "127.0.0.1", 0)
+        port = self.server.sockets[0].getsockname()[1]
+        self.url = "http://127.0.0.1:{}".format(port)
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+        await self.app.shutdown()
+        await self.handler.finish_connections()
+        await self.app.cleanup()
+        await self.github.stop()
+        self.remove_workdir()
+
+    def remove_workdir(self):
+        os.chdir(self.cwd)
+        if self.workdir:
+            shutil.rmtree(self.workdir, ignore_errors=True)
+
+    async def seed(self, count):
+        layers = self.db[model.Layer.collection]
+        repos = self.db[model.Repo.collection]
+        for i in range(count):
+            doc = layer_doc(i)
+            await layers.insert(dict(doc))
+            repo = self.github.add_repo("bench", "repo{}".format(i))
+            await repos.insert({"id": doc["id"],
+                                "name": doc["name"],
+                                "repo": doc["repo"],
+                                "readme_blob": await blobs.Blob.store(
+                                    self.db, repo.files["README.md"],
+                                    "readme"),
+                                "rules": [],
+                                "schema": [],
+                                "version": 1})
+
+
+class Scenario:
+    def __init__(self, name, requests, concurrency, make_request):
+        self.name = name
+        self.requests = requests
+        self.concurrency = concurrency
+        self.make_request = make_request
+
+    async def run(self, env, session):
+        latencies = []
+        errors = 0
+        counter = iter(range(self.requests))
+
+        async def worker():
+            nonlocal errors
+            for i in counter:
+                method, path, kwargs = self.make_request(i)
+                start = time.perf_counter()
+                async with session.request(method, env.url + path,
+                                           **kwargs) as response:
+                    await response.read()
+                    if response.status >= 400:
+                        errors += 1
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*[worker() for _ in range(self.concurrency)])
+        elapsed = time.perf_counter() - start
+        return {"requests": len(latencies),
+                "errors": errors,
+                "concurrency": self.concurrency,
+                "seconds": elapsed,
+                "throughput": len(latencies) / elapsed if elapsed else 0,
+                "p50_ms": percentile(latencies, 50) * 1000,
+                "p99_ms": percentile(latencies, 99) * 1000,
+                "peak_rss_kb": peak_rss_kb()}
+
+
+def http_scenarios(options):
+    n = options.layers
+    rand = random.Random(options.seed)
+    admin = {"Cookie": "u={}".format(user_cookie(ADMIN))}
+    count = options.requests
+    c = options.concurrency
+
+    def listing(i):
+        return "GET", "/api/v2/layers/", {}
+
+    def search(i):
+        return "GET", "/api/v2/layers/", {
+                "params": {"q": "name:layer-{}".format(rand.randrange(n))}}
+
+    def repotext(i):
+        return "GET", "/api/v2/layers/", {
+                "params": {"q": "benchmarking", "repotext": "1"}}
+
+    def bulk_post(i):
+        body = [layer_doc(rand.randrange(n)) for _ in range(20)]
+        return "POST", "/api/v2/layers/", {"data": json.dumps(body),
+                                           "headers": admin}
+
+    def get_item(i):
+        return "GET", "/api/v2/layers/layer-{}/".format(rand.randrange(n)), {}
+
+    def export(i):
+        return "GET", "/api/v2/layers/export", {"headers": admin}
+
+    def bulk_import(i):
+        body = "\n".join(json.dumps(layer_doc(rand.randrange(n)))
+                         for _ in range(200))
+        return "POST", "/api/v2/layers/import", {"data": body,
+                                                 "headers": admin}
+
+    return [Scenario("layer_listing", max(count // 10, 1), c, listing),
+            Scenario("search", count, c, search),
+            Scenario("repotext_search", max(count // 10, 1), c, repotext),
+            Scenario("bulk_post", max(count // 10, 1), c, bulk_post),
+            Scenario("single_get", count, c, get_item),
+            Scenario("ndjson_export", max(count // 100, 1), 1, export),
+            Scenario("ndjson_import", max(count // 100, 1), 1, bulk_import)]
+
+
+async def wait_for_jobs(env, poll=0.01):
+    queue = env.app['jobs']
+    while True:
+        status = await queue.status()
+        if not (status[jobs.PENDING] or status[jobs.RUNNING]):
+            return status
+        await asyncio.sleep(poll)
+
+
+async def sweep_scenario(env):
+    """A watch_repos sweep, measured until the ingest queue drains"""
+    api = model.RepoAPI()
+    calls = env.github.requests
+    start = time.perf_counter()
+    await api.sweep_repos(env.app, env.db)
+    status = await wait_for_jobs(env)
+    elapsed = time.perf_counter() - start
+    repos = len(env.github.repos)
+    return {"repos": repos,
+            "seconds": elapsed,
+            "throughput": repos / elapsed if elapsed else 0,
+            "github_requests": env.github.requests - calls,
+            "failed": status[jobs.FAILED],
+            "peak_rss_kb": peak_rss_kb()}
+
+
+def micro_benchmarks():
+    """CPU bound hot paths measured without the network in the way"""
+    layers = [model.Layer(layer_doc(i)) for i in range(100)]
+    hist = stats.Histogram("bench", "bench", ("a",))
+    cases = {
+        "layer_validate": lambda: layers[0].validate(),
+        "layer_construct": lambda: model.Layer(layer_doc(1)),
+        "dump_100_layers": lambda: dump(layers),
+        "histogram_observe": lambda: hist.observe(.01, "x"),
+        "stats_render": lambda: stats.registry.render(),
+    }
+    results = {}
+    for name, fn in cases.items():
+        timer = timeit.Timer(fn)
+        number = 1
+        # grow the loop count until a run takes a measurable time
+        while timer.timeit(number) < 0.2:
+            number *= 10
+        best = min(timer.repeat(repeat=3, number=number)) / number
+        results[name] = {"us_per_call": best * 1e6, "loops": number}
+    return results
+
+
+async def run(loop, options):
+    env = Environment(loop, options)
+    try:
+        await env.start()
+    except BaseException:
+        env.remove_workdir()
+        raise
+    try:
+        await env.seed(options.layers)
+        results = {}
+        with aiohttp.ClientSession(loop=loop) as session:
+            for scenario in http_scenarios(options):
+                if options.only and scenario.name not in options.only:
+                    continue
+                log.info("Running %s", scenario.name)
+                results[scenario.name] = await scenario.run(env, session)
+        if not options.only or "watch_sweep" in options.only:
+            log.info("Running watch_sweep over %d repos", options.layers)
+            results["watch_sweep"] = await sweep_scenario(env)
+        return results
+    finally:
+        await env.stop()
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+                ["git", "rev-parse", "--short", "HEAD"],
+                cwd=str(Path(__file__).parent),
+                stderr=subprocess.DEVNULL).decode("utf-8").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(baseline, current):
+    lines = []
+    for section in ("scenarios", "micro"):
+        for name, new in sorted(current.get(section, {}).items()):
+            old = baseline.get(section, {}).get(name)
+            if not old:
+                continue
+            for metric in ("throughput", "p50_ms", "p99_ms", "us_per_call"):
+                if metric not in new or not old.get(metric):
+                    continue
+                change = (new[metric] - old[metric]) / old[metric] * 100
+                lines.append("{:<20} {:<12} {:>12.3f} -> {:>12.3f} "
+                             "({:+.1f}%)".format(name, metric, old[metric],
+                                                 new[metric], change))
+    return "\n".join(lines)
+
+
+def report(results):
+    lines = []
+    for name, r in results["scenarios"].items():
+        lines.append("{:<20} {:>10.1f}/s  p50 {:>8.2f}ms  p99 {:>8.2f}ms  "
+                     "rss {:>8}kB".format(name, r["throughput"],
+                                          r.get("p50_ms", 0),
+                                          r.get("p99_ms", 0),
+                                          r["peak_rss_kb"]))
+    for name, r in results["micro"].items():
+        lines.append("{:<20} {:>10.2f}us/call".format(name,
+                                                      r["us_per_call"]))
+    return "\n".join(lines)
+
+
+def setup(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--layers", type=int, default=100,
+                        help="Synthetic layers/repos to seed")
+    parser.add_argument("--requests", type=int, default=2000,
+                        help="Requests per scenario (listing style "
+                             "scenarios run a tenth of this)")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--github-latency", type=float, default=0.0,
+                        help="Seconds of simulated Github latency")
+    parser.add_argument("--ingest-workers", type=int, default=2)
+    parser.add_argument("--ingest-mode", default="tree",
+                        choices=["tree", "tarball", "contents"])
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--only", action="append",
+                        help="Run only the named scenario(s)")
+    parser.add_argument("--no-micro", action="store_true")
+    parser.add_argument("-o", "--output", default="bench_output.json")
+    parser.add_argument("--compare", help="Earlier results to compare with")
+    return parser.parse_args(args)
+
+
+def main():
+    options = setup()
+    logging.basicConfig(level=logging.INFO, format="%(name)s: %(message)s")
+    logging.getLogger("layersite").setLevel(logging.WARN)
+    # the environment changes directory, resolve paths first
+    output = Path(options.output).absolute()
+    baseline = Path(options.compare).absolute() if options.compare else None
+
+    loop = asyncio.get_event_loop()
+    started = datetime.datetime.utcnow()
+    scenarios = loop.run_until_complete(run(loop, options))
+    results = {"meta": {"started": started.isoformat() + "Z",
+                        "revision": git_revision(),
+                        "python": platform.python_version(),
+                        "platform": platform.platform(),
+                        "options": {k: v for k, v in vars(options).items()
+                                    if k not in ("output", "compare")}},
+               "scenarios": scenarios,
+               "micro": {} if options.no_micro else micro_benchmarks()}
+    output.write_text(json.dumps(results, indent=2, sort_keys=True))
+    print(report(results))
+    print("Results written to {}".format(output))
+    if baseline:
+        print(compare(json.loads(baseline.read_text()), results))
+
+
+if __name__ == "__main__":
+    main()
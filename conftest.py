@@ -0,0 +1,3 @@
+# py.test puts the directory of a root conftest.py on sys.path, so tests
+# can import the in process Mongo and Github stand-ins from benchmarks/,
+# which setup.py deliberately leaves out of the installed package.
@@ -0,0 +1,197 @@
+"""Admission control for expensive search requests
+
+Full text and repotext searches can be arbitrarily expensive. Each API
+route gets a concurrency limit with a short bounded wait queue; once the
+queue is full, or a request waits too long, it is rejected at once with
+503 and Retry-After instead of piling up behind the running ones. Each
+client (user login, else remote address) also draws searches from a
+token bucket and gets 429 when it runs dry. Mongo deadlines
+(max_time_ms) bound the searches that are admitted.
+"""
+import asyncio
+import collections
+import logging
+import math
+import time
+
+from aiohttp import web
+
+from . import auth
+from . import stats
+
+log = logging.getLogger("layersite")
+
+admission_shed = stats.registry.counter(
+        "layersite_admission_shed_total",
+        "Requests rejected by admission control",
+        ("route", "reason"))
+admission_queued = stats.registry.counter(
+        "layersite_admission_queued_total",
+        "Requests that waited for a concurrency slot",
+        ("route",))
+admission_waiting = stats.registry.gauge(
+        "layersite_admission_waiting",
+        "Requests currently waiting for a concurrency slot",
+        ("route",))
+
+
+def service_unavailable(retry_after, reason):
+    return web.HTTPServiceUnavailable(
+            reason=reason,
+            headers={"Retry-After": str(max(1, math.ceil(retry_after)))})
+
+
+def client_key(request):
+    """The user login, or the remote address for anonymous clients"""
+    user = auth.get_current_user(request)
+    if user:
+        return "user:" + user["login"]
+    peername = request.transport.get_extra_info('peername')
+    return "addr:" + (peername[0] if peername else "unknown")
+
+
+class Limiter:
+    """At most `concurrency` holders, at most `queue` waiters
+
+    Waiters are served in arrival order; release hands the slot straight
+    to the oldest waiter so a burst of new arrivals can't overtake it.
+    """
+
+    def __init__(self, route, concurrency, queue, wait):
+        self.route = route
+        self.concurrency = concurrency
+        self.queue = queue
+        self.wait = wait
+        self.active = 0
+        self.waiters = collections.deque()
+
+    async def acquire(self):
+        if self.active < self.concurrency and not self.waiters:
+            self.active += 1
+            return
+        if len(self.waiters) >= self.queue:
+            admission_shed.inc(self.route, "queue_full")
+            raise service_unavailable(self.wait, "Search capacity exceeded")
+
+        waiter = asyncio.Future()
+        self.waiters.append(waiter)
+        admission_queued.inc(self.route)
+        admission_waiting.inc(self.route)
+        try:
+            await asyncio.wait_for(waiter, self.wait)
+        except asyncio.TimeoutError:
+            self.return_handed_slot(waiter)
+            admission_shed.inc(self.route, "timeout")
+            raise service_unavailable(self.wait, "Search capacity exceeded")
+        except asyncio.CancelledError:
+            self.return_handed_slot(waiter)
+            raise
+        finally:
+            admission_waiting.dec(self.route)
+            if waiter in self.waiters:
+                self.waiters.remove(waiter)
+
+    def return_handed_slot(self, waiter):
+        # release() may have handed this waiter a slot in the same tick
+        # the wait gave up; pass it on rather than leak it
+        if waiter.done() and not waiter.cancelled():
+            self.release()
+
+    def release(self):
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, *exc):
+        self.release()
+
+
+class TokenBuckets:
+    """Per client token buckets, forgetting the least recently seen"""
+    MAX_CLIENTS = 10000
+
+    def __init__(self, rate, burst, max_clients=MAX_CLIENTS):
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        self.buckets = collections.OrderedDict()
+
+    def take(self, key, now=None):
+        """Spend a token for key, returning 0 or seconds until one is free"""
+        if now is None:
+            now = time.monotonic()
+        tokens, stamp = self.buckets.pop(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - stamp) * self.rate)
+        wait = 0
+        if tokens >= 1:
+            tokens -= 1
+        else:
+            wait = (1 - tokens) / self.rate
+        self.buckets[key] = (tokens, now)
+        if len(self.buckets) > self.max_clients:
+            self.buckets.popitem(last=False)
+        return wait
+
+
+class Admission:
+    CONCURRENCY = 8
+    QUEUE = 16
+    WAIT = 2.0
+    RATE = 5.0
+    BURST = 20
+    MAX_TIME_MS = 5000
+
+    def __init__(self, concurrency=CONCURRENCY, queue=QUEUE, wait=WAIT,
+                 rate=RATE, burst=BURST, max_time_ms=MAX_TIME_MS):
+        self.concurrency = concurrency
+        self.queue = queue
+        self.wait = wait
+        self.max_time_ms = max_time_ms
+        self.limiters = {}
+        self.clients = TokenBuckets(rate, burst) if rate else None
+
+    def limiter(self, route):
+        if route not in self.limiters:
+            self.limiters[route] = Limiter(route, self.concurrency,
+                                           self.queue, self.wait)
+        return self.limiters[route]
+
+    def check_rate(self, route, client):
+        if self.clients is None:
+            return
+        wait = self.clients.take(client)
+        if wait:
+            admission_shed.inc(route, "rate")
+            raise web.HTTPTooManyRequests(
+                    reason="Too many searches",
+                    headers={"Retry-After": str(max(1, math.ceil(wait)))})
+
+    def admit(self, route, client):
+        """Rate check `client` and return the route's limiter to hold"""
+        self.check_rate(route, client)
+        return self.limiter(route)
+
+    def deadline_exceeded(self, route):
+        admission_shed.inc(route, "deadline")
+        log.info("Query on %s exceeded its %dms deadline", route,
+                 self.max_time_ms)
+        return service_unavailable(self.wait, "Search took too long")
+
+
+def configure(options):
+    return Admission(
+            concurrency=getattr(options, "search_concurrency",
+                                Admission.CONCURRENCY),
+            queue=getattr(options, "search_queue", Admission.QUEUE),
+            wait=getattr(options, "search_wait", Admission.WAIT),
+            rate=getattr(options, "search_rate", Admission.RATE),
+            burst=getattr(options, "search_burst", Admission.BURST),
+            max_time_ms=getattr(options, "query_timeout_ms",
+                                Admission.MAX_TIME_MS))
@@ -1,27 +1,51 @@
+import asyncio
+import datetime
+import json
+import logging
+import time
+
 from aiohttp import web
 
 from bson.json_util import dumps
-from strict_rfc3339 import now_to_rfc3339_utcoffset
 import aiohttp_jinja2
+import jsonschema
+from pymongo import InsertOne, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, ExecutionTimeout
 
+from . import admission
 from . import auth
+from . import changes
 from . import document
+from . import stats
+from .metrics import Metric, MetricRollup
+
+log = logging.getLogger("layersite")
+
+bulk_documents = stats.registry.counter(
+        "layersite_bulk_documents_total",
+        "Documents streamed through NDJSON export and import",
+        ("collection", "direction"))
+bulk_duration = stats.registry.histogram(
+        "layersite_bulk_duration_seconds",
+        "Duration of NDJSON exports and imports",
+        ("collection", "direction"),
+        buckets=(.1, .5, 1, 5, 10, 30, 60, 300, 900))
 
 
 def dump(obj):
     return dumps(obj, indent=2)
 
 
-# One built in Document kind we manage
-class Metric(document.Document):
-    collection = "metrics"
-    schema = document.loader("metrics.schema")
-    pk = None
-    default_sort = None
+def is_primary(app):
+    """True in the one worker that should run singleton background tasks"""
+    return getattr(app['options'], "primary", True)
 
 
 class RESTBase:
     headers = {'Content-Type': 'application/json', }
+    # serve /<endpoint>/changes, see changes.py
+    changes = True
+    HEARTBEAT = 15
 
     @classmethod
     def from_request(cls, request):
@@ -48,6 +72,11 @@ class RESTBase:
     def get_current_user(self):
         return auth.get_current_user(self.request)
 
+    def is_admin(self, user=None):
+        if user is None:
+            user = self.get_current_user()
+        return bool(user) and user['login'] in self.app['admin_users']
+
     @property
     def app(self):
         return self.request.app
@@ -92,18 +121,94 @@ class RESTBase:
         Handles user auth
         Method level ACL
         """
+        m = None
         mn = request.method.lower()
         if hasattr(self, mn):
             ins = self.from_request(request)
             m = getattr(ins, request.method.lower(), None)
         if not m:
             raise web.HTTPMethodNotAllowed(request)
-        # perm checks
-        await self.verify_permissions()
-        return await m(**dict(request.match_info))
+        return await self.dispatch(request, m, type(self).__name__)
+
+    def handler(self, name):
+        """Route handler calling method `name` on a per request instance"""
+        api = "{}.{}".format(type(self).__name__, name)
+
+        async def handle(request):
+            m = getattr(self.from_request(request), name)
+            return await self.dispatch(request, m, api)
+        return handle
+
+    def is_search(self, request):
+        """True for requests that go through admission control"""
+        return False
+
+    async def dispatch(self, request, m, api):
+        status = 500
+        start = time.perf_counter()
+        stats.http_in_flight.inc(api)
+        control = request.app.get('admission')
+        try:
+            # perm checks
+            await self.verify_permissions()
+            if control is not None and self.is_search(request):
+                limiter = control.admit(api, admission.client_key(request))
+                async with limiter:
+                    response = await m(**dict(request.match_info))
+            else:
+                response = await m(**dict(request.match_info))
+            status = response.status
+            return response
+        except ExecutionTimeout:
+            # only searches carry a deadline, see RESTCollection.max_time_ms
+            e = control.deadline_exceeded(api)
+            status = e.status
+            raise e
+        except web.HTTPException as e:
+            status = e.status
+            raise
+        finally:
+            stats.http_in_flight.dec(api)
+            stats.http_duration.observe(time.perf_counter() - start,
+                                        api, request.method, status)
+
+    async def change_feed(self):
+        """Stream change events of this endpoint as Server-Sent Events
+
+        A comment line is sent every HEARTBEAT seconds so proxies keep the
+        connection open and a vanished client is noticed.
+        """
+        sub = changes.hub.subscribe(self.factory.collection)
+        try:
+            response = web.StreamResponse(
+                    headers={'Content-Type': 'text/event-stream',
+                             'Cache-Control': 'no-cache',
+                             'X-Accel-Buffering': 'no'})
+            await response.prepare(self.request)
+            response.write(b"retry: 5000\n\n")
+            while True:
+                try:
+                    event = await sub.get(self.HEARTBEAT)
+                except asyncio.TimeoutError:
+                    response.write(b": heartbeat\n\n")
+                else:
+                    if event is None:
+                        if sub.evicted:
+                            response.write(b"event: evicted\ndata: {}\n\n")
+                        break
+                    response.write(changes.format_event(event))
+                await response.drain()
+            await response.write_eof()
+        except ConnectionResetError:
+            log.debug("Change feed client of %s went away",
+                      self.factory.collection)
+        finally:
+            sub.close()
+        return response
 
     async def add_metric(self, data):
-        data['timestamp'] = now_to_rfc3339_utcoffset()
+        # A real date so the TTL index on metrics can expire it
+        data['timestamp'] = datetime.datetime.utcnow()
         peername = self.request.transport.get_extra_info('peername')
         if peername is not None:
                 host, port = peername
@@ -114,14 +219,108 @@ class RESTBase:
         obj = Metric()
         obj.update(data)
         await obj.save(self.db, w=0)
+        await MetricRollup.record(self.db, obj, when=data['timestamp'], w=0)
+
+
+def etag(version):
+    return '"{}"'.format(version)
+
+
+def parse_etag(value):
+    """Return the version from an If-Match header, None for '*'"""
+    value = value.strip()
+    if value == "*":
+        return None
+    if value.startswith("W/"):
+        value = value[2:]
+    try:
+        return int(value.strip('"'))
+    except ValueError:
+        raise web.HTTPBadRequest(reason="If-Match must be a version ETag")
 
 
 class RESTResource(RESTBase):
     async def get(self, uid):
         uid = uid.rstrip("/")
         result = await self.factory.find(self.db, id=uid)
+        headers = self.headers
+        if result and self.factory.versioned():
+            headers = dict(headers, ETag=etag(result[0].get("version", 1)))
         return web.Response(text=dump(result[0] if result else []),
-                            headers=self.headers)
+                            headers=headers)
+
+    async def patch(self, uid):
+        """Apply a JSON merge patch, writing only the fields it names
+
+        Ownership and the optional If-Match version are part of the
+        update filter, so a lost update is rejected without reading the
+        document first. Only when nothing matched is it read to decide
+        between 404, 401 and 412.
+        """
+        uid = uid.rstrip("/")
+        user = self.get_current_user()
+        if not user:
+            raise web.HTTPUnauthorized(reason="Github user not authorized")
+        try:
+            patch = await self.request.json()
+        except ValueError:
+            raise web.HTTPBadRequest(reason="Body must be a JSON object")
+        if not isinstance(patch, dict):
+            raise web.HTTPBadRequest(reason="Body must be a JSON object")
+        pk = self.factory.pk
+        fixed = (pk, "_id", "version", "lastmodified")
+        if any(field in patch for field in fixed):
+            raise web.HTTPBadRequest(
+                    reason="{}, {}, {} and {} can't be patched".format(
+                        *fixed))
+        try:
+            sets, unsets = document.merge_patch_paths(
+                    patch, self.factory.schema)
+            self.factory.validate_paths(sets, unsets)
+        except ValueError as e:
+            raise web.HTTPBadRequest(reason=str(e))
+        except jsonschema.ValidationError as e:
+            raise web.HTTPBadRequest(reason=e.message)
+
+        spec = {pk: uid}
+        expected = None
+        if_match = self.request.headers.get("If-Match")
+        if if_match and self.factory.versioned():
+            expected = parse_etag(if_match)
+        if expected is not None:
+            # documents written before versioning are implicitly 1
+            spec["version"] = {"$in": [1, None]} if expected == 1 \
+                else expected
+        if not self.is_admin(user):
+            spec["owner"] = user["login"]
+
+        sets["lastmodified"] = datetime.datetime.utcnow()
+        update = {"$set": sets}
+        if unsets:
+            update["$unset"] = {path: "" for path in unsets}
+        if self.factory.versioned():
+            update["$inc"] = {"version": 1}
+
+        collection = getattr(self.db, self.factory.collection)
+        with stats.mongo_timer(self.factory.collection, "patch"):
+            result = await collection.find_one_and_update(
+                    spec, update, projection={"_id": 0, "lastmodified": 0},
+                    return_document=ReturnDocument.AFTER)
+        if result is None:
+            existing = await collection.find_one({pk: uid})
+            if existing is None:
+                raise web.HTTPNotFound()
+            if not (await self.verify_write_permissions(existing, user)):
+                raise web.HTTPUnauthorized(reason="Github user not authorized")
+            raise web.HTTPPreconditionFailed(
+                    headers={"ETag": etag(existing.get("version", 1))})
+
+        changes.publish(self.factory.collection, uid, changes.SAVE)
+        await self.add_metric({"action": "patch", "item": uid})
+        headers = self.headers
+        if self.factory.versioned():
+            headers = dict(headers, ETag=etag(result.get("version", 1)))
+        return web.Response(text=dump(result), headers=headers)
 
     async def post(self, uid):
         body = await self.request.json()
@@ -170,6 +369,17 @@ class RESTResource(RESTBase):
 
 
 class RESTCollection(RESTBase):
+    def is_search(self, request):
+        if request.method != "GET":
+            return False
+        return "repotext" in request.GET or \
+            any(":" not in q for q in request.GET.getall("q", []))
+
+    @property
+    def max_time_ms(self):
+        control = self.app.get('admission')
+        return control.max_time_ms if control is not None else None
+
     def parse_search_query(self):
         result = {}
         q = self.request.GET.getall("q", [])
@@ -186,7 +396,8 @@ class RESTCollection(RESTBase):
     async def get(self):
         q = self.parse_search_query()
         response = []
-        for iface in (await self.factory.find(self.db, q)):
+        for iface in (await self.factory.find(
+                self.db, q, max_time_ms=self.max_time_ms)):
             response.append(iface)
         return web.Response(text=dump(response), headers=self.headers)
 
@@ -209,3 +420,148 @@ class RESTCollection(RESTBase):
             await self.add_metric({"action": "update",
                                    "item": document['id']})
         return web.Response(status=200)
+
+    # NDJSON bulk transfer. Both directions work a batch at a time so
+    # memory use is independent of the collection size.
+    importable = True
+    EXPORT_BATCH = 500
+    IMPORT_BATCH = 500
+    MAX_IMPORT_ERRORS = 100
+
+    async def export_ndjson(self):
+        if not self.is_admin():
+            raise web.HTTPUnauthorized(reason="Admin access required")
+        q = self.parse_search_query()
+        collection = getattr(self.db, self.factory.collection)
+        response = web.StreamResponse(
+                headers={'Content-Type': 'application/x-ndjson'})
+        await response.prepare(self.request)
+
+        start = time.perf_counter()
+        count = 0
+        batch = []
+        cursor = collection.find(q, {"_id": 0})
+        cursor.batch_size(self.EXPORT_BATCH)
+        async for doc in cursor:
+            batch.append(dumps(doc))
+            count += 1
+            if len(batch) >= self.EXPORT_BATCH:
+                response.write(("\n".join(batch) + "\n").encode("utf-8"))
+                # wait for the client before pulling the next batch
+                await response.drain()
+                batch = []
+        if batch:
+            response.write(("\n".join(batch) + "\n").encode("utf-8"))
+        await response.write_eof()
+
+        elapsed = time.perf_counter() - start
+        bulk_documents.inc(self.factory.collection, "export", amount=count)
+        bulk_duration.observe(elapsed, self.factory.collection, "export")
+        log.info("Exported %d %s documents in %.2fs (%.0f/s)", count,
+                 self.factory.collection, elapsed,
+                 count / elapsed if elapsed else 0)
+        return response
+
+    async def apply_batch(self, documents):
+        """Write documents unordered, returning {index: error} of rejects
+
+        Mongo still writes the rest of the batch when some documents are
+        refused (a conflicting _id, a key with a dot, an oversized
+        document).
+        """
+        collection = getattr(self.db, self.factory.collection)
+        now = datetime.datetime.utcnow()
+        requests = []
+        for doc in documents:
+            doc.setdefault('lastmodified', now)
+            if self.factory.pk:
+                # bumps the stored version, never takes the imported one
+                requests.append(UpdateOne({self.factory.pk: doc.id},
+                                          doc.update_spec(), upsert=True))
+            else:
+                requests.append(InsertOne(dict(doc)))
+        rejected = {}
+        try:
+            await collection.bulk_write(requests, ordered=False)
+        except BulkWriteError as e:
+            for error in e.details.get("writeErrors", []):
+                rejected[error["index"]] = error.get("errmsg", "")
+        if self.factory.pk:
+            for i, doc in enumerate(documents):
+                if i not in rejected:
+                    changes.publish(self.factory.collection, doc.id,
+                                    changes.SAVE)
+        return rejected
+
+    async def import_ndjson(self):
+        """Upsert newline delimited JSON documents from the request body
+
+        The body is read a line at a time and each batch is written before
+        more is read, so a slow database pushes back on the client.
+        """
+        if not self.is_admin():
+            raise web.HTTPUnauthorized(reason="Admin access required")
+        if not self.importable:
+            raise web.HTTPMethodNotAllowed("POST", [])
+
+        start = time.perf_counter()
+        stream = self.request.content
+        imported = 0
+        batches = 0
+        errors = []
+        error_count = 0
+        lineno = 0
+        batch = []
+        lines = []
+
+        def reject(lineno, message):
+            nonlocal error_count
+            error_count += 1
+            if len(errors) < self.MAX_IMPORT_ERRORS:
+                errors.append({"line": lineno, "error": message})
+
+        async def flush():
+            nonlocal imported, batches
+            rejected = await self.apply_batch(batch)
+            for i, message in sorted(rejected.items()):
+                reject(lines[i], message)
+            imported += len(batch) - len(rejected)
+            batches += 1
+
+        while True:
+            line = await stream.readline()
+            if not line:
+                break
+            lineno += 1
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                doc = self.factory(line.decode("utf-8"))
+                doc.validate()
+            except (ValueError, TypeError, jsonschema.ValidationError) as e:
+                reject(lineno, getattr(e, "message", str(e)))
+                continue
+            batch.append(doc)
+            lines.append(lineno)
+            if len(batch) >= self.IMPORT_BATCH:
+                await flush()
+                batch = []
+                lines = []
+        if batch:
+            await flush()
+
+        elapsed = time.perf_counter() - start
+        bulk_documents.inc(self.factory.collection, "import",
+                           amount=imported)
+        bulk_duration.observe(elapsed, self.factory.collection, "import")
+        await self.add_metric({"action": "import",
+                               "item": "{} documents".format(imported)})
+        result = {"imported": imported,
+                  "batches": batches,
+                  "errors": error_count,
+                  "error_details": errors,
+                  "seconds": elapsed,
+                  "documents_per_second": imported / elapsed if elapsed
+                  else 0}
+        return web.Response(text=json.dumps(result), headers=self.headers)
@@ -1,15 +1,19 @@
 import base64
 import json
 import logging
+import time
 
 import aiohttp
 from aiohttp import web
 from aioauth_client import GithubClient
 
+from . import stats
+
 
 class GithubAPI:
+    endpoint = "https://api.github.com"
+
     def __init__(self, access_token=None):
-        self.endpoint = "https://api.github.com"
         self.token = access_token
         self._timeout = 10
         self._headers = {
@@ -19,17 +23,55 @@ class GithubAPI:
             self._headers['Authorization'] = 'token {}'.format(access_token)
         self._client = aiohttp.ClientSession()
 
-    async def get(self, url):
+    def full_url(self, url):
         url = url[1:] if url.startswith("/") else url
         if not url.startswith("http"):
             url = self.endpoint + "/" + url
-        with aiohttp.Timeout(self._timeout):
-            async with self._client.get(
-                    url, headers=self._headers) as response:
-                if response.status >= 400:
-                    logging.warn("Failure to fetch %s", url)
-                    raise response
-                return await response.json()
+        return url
+
+    async def get(self, url):
+        url = self.full_url(url)
+        status = "error"
+        start = time.perf_counter()
+        try:
+            with aiohttp.Timeout(self._timeout):
+                async with self._client.get(
+                        url, headers=self._headers) as response:
+                    status = response.status
+                    if response.status >= 400:
+                        logging.warn("Failure to fetch %s", url)
+                        raise response
+                    return await response.json()
+        finally:
+            stats.github_duration.observe(time.perf_counter() - start,
+                                          stats.github_endpoint(url), status)
+
+    async def stream(self, url, sink, chunk_size=64 * 1024, timeout=120):
+        """Feed a (possibly large, redirected) response to coroutine sink
+
+        Each chunk is awaited before the next is read, so a slow sink
+        pushes back on the download.
+        """
+        url = self.full_url(url)
+        status = "error"
+        start = time.perf_counter()
+        try:
+            with aiohttp.Timeout(timeout):
+                async with self._client.get(
+                        url, headers=self._headers) as response:
+                    status = response.status
+                    if response.status >= 400:
+                        logging.warn("Failure to fetch %s", url)
+                        raise IOError("Failure to fetch {}: {}".format(
+                            url, response.status))
+                    while True:
+                        chunk = await response.content.read(chunk_size)
+                        if not chunk:
+                            break
+                        await sink(chunk)
+        finally:
+            stats.github_duration.observe(time.perf_counter() - start,
+                                          stats.github_endpoint(url), status)
 
     def __enter__(self):
         return self
@@ -8,6 +8,8 @@ from pathlib import Path
 import jinja2
 from aiohttp import web
 
+from . import stats
+
 
 log = logging.getLogger(__name__)
 
@@ -29,6 +31,10 @@ class Babel:
 
         if not loop:
             loop = asyncio.get_event_loop()
+        with stats.babel_duration.time():
+            return await self.transform(sourcefile, stream, loop)
+
+    async def transform(self, sourcefile, stream, loop):
         try:
             cmd = ["babel", "--presets", ",".join(self.presets)]
             if sourcefile:
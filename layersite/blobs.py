@@ -0,0 +1,142 @@
+import datetime
+import hashlib
+import json
+import logging
+
+import motor
+from pymongo.errors import DuplicateKeyError
+
+from . import document
+
+log = logging.getLogger("layersite")
+
+# GitHub metadata worth keeping on an ingested file reference
+ITEM_FIELDS = ("name", "path", "sha", "size", "type")
+
+
+def content_hash(value):
+    """sha256 of the canonical JSON form of a string or parsed document"""
+    canonical = json.dumps(value, sort_keys=True, separators=(",", ":"),
+                           ensure_ascii=False, default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class Blob(document.Document):
+    """Content addressed storage for large ingested fields
+
+    Blobs are immutable and keyed by content_hash so identical READMEs,
+    rules and schemas shared between repos are stored once. Text blobs
+    keep their content in `text` (covered by the full text index),
+    parsed YAML in `data`.
+    """
+    collection = "blobs"
+    schema = document.loader("blob.schema")
+    pk = "id"
+    default_sort = None
+
+    @classmethod
+    async def prepare(cls, db):
+        db = getattr(db, cls.collection)
+        await db.ensure_index("id", name="id", unique=True)
+        await db.ensure_index([("text", motor.pymongo.TEXT)], name="fts")
+
+    @classmethod
+    async def store(cls, db, value, kind):
+        """Write value unless a blob with its hash exists, return the hash"""
+        key = content_hash(value)
+        doc = {"id": key, "kind": kind,
+               "created": datetime.datetime.utcnow()}
+        if isinstance(value, str):
+            doc.update(text=value, size=len(value))
+        else:
+            doc["data"] = value
+        try:
+            await getattr(db, cls.collection).update(
+                    {"id": key}, {"$setOnInsert": doc}, upsert=True)
+        except DuplicateKeyError:
+            # a concurrent ingest stored the same content first
+            log.debug("Blob %s already stored", key)
+        return key
+
+    @classmethod
+    async def fetch(cls, db, keys):
+        """Return {hash: content} for the requested hashes"""
+        keys = [k for k in set(keys) if k]
+        if not keys:
+            return {}
+        result = {}
+        cursor = getattr(db, cls.collection).find({"id": {"$in": keys}})
+        async for doc in cursor:
+            result[doc["id"]] = doc["text"] if "text" in doc \
+                else doc.get("data")
+        return result
+
+    @classmethod
+    async def search_text(cls, db, search, kind=None, max_time_ms=None):
+        """Hashes of text blobs matching a $text search"""
+        query = {"$text": {"$search": search}}
+        if kind:
+            query["kind"] = kind
+        cursor = getattr(db, cls.collection).find(query, {"id": 1})
+        if max_time_ms:
+            cursor.max_time_ms(max_time_ms)
+        return [doc["id"] async for doc in cursor]
+
+
+async def externalize(db, data, existing):
+    """Move readme/rules/schema content of an ingest into blobs
+
+    `data` is the freshly ingested repo content, `existing` the stored
+    Repo. Content whose hash is already referenced by `existing` is not
+    written again. Returns the reference only form of `data`.
+    """
+    known = set()
+    known.add(existing.get("readme_blob"))
+    for field in ("rules", "schema"):
+        for item in existing.get(field) or []:
+            known.add(item.get("blob"))
+
+    result = {k: v for k, v in data.items() if k not in ("readme",)}
+    if data.get("readme") is not None:
+        key = content_hash(data["readme"])
+        if key not in known:
+            await Blob.store(db, data["readme"], "readme")
+        result["readme_blob"] = key
+
+    for field in ("rules", "schema"):
+        refs = []
+        for item in data.get(field) or []:
+            ref = {k: item[k] for k in ITEM_FIELDS if k in item}
+            if "content" in item:
+                key = content_hash(item["content"])
+                if key not in known:
+                    await Blob.store(db, item["content"], field)
+                    known.add(key)
+                ref["blob"] = key
+            else:
+                # reused reference from the previous ingest
+                ref["blob"] = item.get("blob")
+            refs.append(ref)
+        result[field] = refs
+    return result
+
+
+async def expand(db, docs, fields):
+    """Replace blob references in docs with their content, in place"""
+    keys = []
+    for doc in docs:
+        if "readme" in fields:
+            keys.append(doc.get("readme_blob"))
+        for field in ("rules", "schema"):
+            if field in fields:
+                keys.extend(item.get("blob") for item in doc.get(field) or [])
+    content = await Blob.fetch(db, keys)
+    for doc in docs:
+        if "readme" in fields:
+            dict.__setitem__(doc, "readme",
+                             content.get(doc.get("readme_blob"), ""))
+        for field in ("rules", "schema"):
+            if field in fields:
+                for item in doc.get(field) or []:
+                    item["content"] = content.get(item.get("blob"))
+    return docs
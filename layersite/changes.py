@@ -0,0 +1,198 @@
+"""Fan-out of document change events to Server-Sent Events clients
+
+Every write through Document.save/remove and every completed repo ingest
+publishes a small (collection, id, kind) event to the process wide `hub`.
+The hub copies it into a bounded queue per subscribed client; a client
+that falls a full buffer behind is evicted rather than allowed to grow
+memory or stall the publisher.
+
+Local publishes only reach clients of the worker process that made the
+write. When the Mongo deployment supports change streams (replica sets
+and sharded clusters) the hub is instead fed from them, so every worker
+sees every write, and local publishes are ignored to avoid duplicates.
+Deletes are the exception: a change stream delete only carries the Mongo
+_id, not the id clients know, so removes are always published locally.
+"""
+import asyncio
+import itertools
+import json
+import logging
+
+from pymongo.errors import PyMongoError
+
+from . import stats
+
+log = logging.getLogger("layersite")
+
+SAVE = "save"
+REMOVE = "remove"
+INGEST = "ingest"
+
+change_events = stats.registry.counter(
+        "layersite_change_events_total",
+        "Change events published to the SSE hub",
+        ("collection", "kind"))
+change_subscribers = stats.registry.gauge(
+        "layersite_change_subscribers",
+        "Connected change feed clients",
+        ("collection",))
+change_evicted = stats.registry.counter(
+        "layersite_change_evicted_total",
+        "Change feed clients dropped for falling behind",
+        ("collection",))
+
+
+def format_event(event):
+    """Encode an event as a text/event-stream message"""
+    return "id: {}\nevent: {}\ndata: {}\n\n".format(
+            event["seq"], event["kind"],
+            json.dumps(event, sort_keys=True)).encode("utf-8")
+
+
+class Subscription:
+    def __init__(self, hub, collection, maxsize):
+        self.hub = hub
+        self.collection = collection
+        self.queue = asyncio.Queue(maxsize=maxsize)
+        self.evicted = False
+
+    async def get(self, timeout):
+        """Next event, None once closed; TimeoutError when idle"""
+        return await asyncio.wait_for(self.queue.get(), timeout)
+
+    def close(self, evicted=False):
+        """Detach from the hub and wake the reader with a None"""
+        if self not in self.hub.subscribers:
+            return
+        self.hub.subscribers.discard(self)
+        change_subscribers.dec(self.collection)
+        self.evicted = evicted
+        # make room so the sentinel always fits
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        self.queue.put_nowait(None)
+
+
+class ChangeHub:
+    BUFFER = 256
+
+    def __init__(self, buffer=BUFFER):
+        self.buffer = buffer
+        self.subscribers = set()
+        self.streaming = False
+        self.tasks = []
+        self.seq = itertools.count(1)
+
+    def subscribe(self, collection):
+        sub = Subscription(self, collection, self.buffer)
+        self.subscribers.add(sub)
+        change_subscribers.inc(collection)
+        return sub
+
+    def publish(self, collection, oid, kind):
+        """Publish a local write, unless change streams already carry it"""
+        if not self.streaming or kind == REMOVE:
+            self.dispatch(collection, oid, kind)
+
+    def dispatch(self, collection, oid, kind):
+        change_events.inc(collection, kind)
+        if not self.subscribers:
+            return
+        event = {"seq": next(self.seq), "collection": collection,
+                 "id": oid, "kind": kind}
+        for sub in list(self.subscribers):
+            if sub.collection != collection:
+                continue
+            try:
+                sub.queue.put_nowait(event)
+            except asyncio.QueueFull:
+                log.info("Evicting slow change feed client of %s",
+                         collection)
+                change_evicted.inc(collection)
+                sub.close(evicted=True)
+
+    def close(self):
+        for sub in list(self.subscribers):
+            sub.close()
+        for task in self.tasks:
+            task.cancel()
+        self.tasks = []
+        self.streaming = False
+
+    # Change stream feed
+
+    @staticmethod
+    async def supports_streams(db):
+        try:
+            info = await db.command("isMaster")
+        except PyMongoError:
+            return False
+        # change streams need an oplog: a replica set or a mongos
+        return bool(info.get("setName")) or info.get("msg") == "isdbgrid"
+
+    async def follow(self, loop, db, collections, jobs=None):
+        """Feed the hub from change streams on `collections`
+
+        Completed ingests are derived from `jobs` moving to done, the
+        stream equivalent of the publish in RepoAPI.ingest_repo. Returns
+        False, leaving local publishing in place, when the deployment has
+        no change streams.
+        """
+        if not hasattr(getattr(db, collections[0]), "watch") or \
+                not (await self.supports_streams(db)):
+            log.info("Change streams unavailable, change feed is per process")
+            return False
+        self.streaming = True
+        for name in collections:
+            self.tasks.append(loop.create_task(
+                self.watch(getattr(db, name), self.document_change)))
+        if jobs:
+            collection, target = jobs
+            self.tasks.append(loop.create_task(
+                self.watch(getattr(db, collection),
+                           self.ingest_change(target),
+                           [{"$match": {"operationType": "update",
+                                        "fullDocument.state": "done"}}])))
+        return True
+
+    async def watch(self, collection, translate, pipeline=None):
+        pipeline = (pipeline or []) + [
+                {"$project": {"operationType": 1, "documentKey": 1,
+                              "fullDocument.id": 1,
+                              "fullDocument.layer": 1}}]
+        try:
+            async with collection.watch(pipeline,
+                                        full_document="updateLookup") as s:
+                async for change in s:
+                    event = translate(collection.name, change)
+                    if event is not None:
+                        self.dispatch(*event)
+        except asyncio.CancelledError:
+            raise
+        except PyMongoError:
+            log.exception("Change stream on %s failed, falling back to "
+                          "local change events", collection.name)
+            self.streaming = False
+
+    @staticmethod
+    def document_change(collection, change):
+        # deletes carry no document, only its _id; they are published
+        # locally by Document.remove instead
+        oid = (change.get("fullDocument") or {}).get("id")
+        if change["operationType"] == "delete" or not oid:
+            return None
+        return collection, oid, SAVE
+
+    @staticmethod
+    def ingest_change(target):
+        def translate(collection, change):
+            layer = (change.get("fullDocument") or {}).get("layer")
+            return (target, layer, INGEST) if layer else None
+        return translate
+
+
+hub = ChangeHub()
+
+
+def publish(collection, oid, kind):
+    hub.publish(collection, oid, kind)
@@ -1,19 +1,88 @@
 from bson.json_util import loads, dumps
+from pathlib import Path
 import datetime
+import json
 import logging
-import pkg_resources
 
 
 import jsonschema
 import motor
 import yaml
+from pymongo.errors import OperationFailure
+
+from . import changes
+from .parsing import YAMLLoader
+from .stats import mongo_timer, startup_phase
 
 log = logging.getLogger(__name__)
 
+PACKAGE_DIR = Path(__file__).parent
+SCHEMA_CACHE = PACKAGE_DIR / "__pycache__"
+
+
+def compile_schema(source, cache):
+    data = yaml.load(source.read_text(), Loader=YAMLLoader)
+    try:
+        cache.parent.mkdir(exist_ok=True)
+        cache.write_text(json.dumps(data))
+    except OSError:
+        # read only installs simply parse the YAML every time
+        log.debug("Unable to cache compiled schema %s", cache)
+    return data
+
 
 def loader(filename):
-    fn = pkg_resources.resource_filename(__name__, filename)
-    return yaml.load(open(fn).read())
+    """Load a packaged YAML schema
+
+    The parsed form is cached as JSON next to the bytecode and reused
+    while it is newer than the YAML source.
+    """
+    with startup_phase("schemas"):
+        source = PACKAGE_DIR / filename
+        cache = SCHEMA_CACHE / (filename + ".json")
+        try:
+            if cache.stat().st_mtime >= source.stat().st_mtime:
+                return json.loads(cache.read_text())
+        except (OSError, ValueError):
+            pass
+        return compile_schema(source, cache)
+
+
+def compile_schemas():
+    """Precompile every packaged schema, for use at build time"""
+    for source in sorted(PACKAGE_DIR.glob("*.schema")):
+        compile_schema(source, SCHEMA_CACHE / (source.name + ".json"))
+
+
+def merge_patch_paths(patch, schema=None, prefix=""):
+    """Flatten a JSON merge patch (RFC 7396) into $set and $unset paths
+
+    Nested objects are merged field by field using dotted paths and null
+    removes a field, so only what the patch names is written. An object
+    patching a field `schema` describes as something other than an object
+    replaces it whole, as the RFC has it, so it is validated (and
+    rejected) as that field instead of being merged into it.
+    """
+    sets = {}
+    unsets = []
+    for key, value in patch.items():
+        if not key or "." in key or key.startswith("$"):
+            raise ValueError("Invalid field name {!r}".format(key))
+        path = prefix + key
+        spec = None
+        if schema is not None:
+            spec = schema.get('properties', {}).get(key)
+        if value is None:
+            unsets.append(path)
+        elif isinstance(value, dict) and \
+                (spec is None or spec.get('type', 'object') == 'object'):
+            nested_sets, nested_unsets = merge_patch_paths(
+                    value, spec, path + ".")
+            sets.update(nested_sets)
+            unsets.extend(nested_unsets)
+        else:
+            sets[path] = value
+    return sets, unsets
 
 
 class DocumentBase(dict):
@@ -67,6 +136,29 @@ class DocumentBase(dict):
             result[k] = value
         return result
 
+    @classmethod
+    def subschema(cls, path):
+        """The schema for a dotted path, or None when it isn't described"""
+        spec = cls.schema
+        for part in path.split("."):
+            spec = spec.get('properties', {}).get(part)
+            if spec is None:
+                return None
+        return spec
+
+    @classmethod
+    def validate_paths(cls, sets, unsets=()):
+        """Validate only the fields a partial update touches"""
+        required = set(cls.schema.get('required', []))
+        for path in unsets:
+            if path in required:
+                raise ValueError("{} is required".format(path))
+        for path, value in sets.items():
+            spec = cls.subschema(path)
+            if spec is not None:
+                jsonschema.validate(value, spec,
+                                    format_checker=jsonschema.FormatChecker())
+
     @classmethod
     def properties(cls):
         return cls.schema['properties'].keys()
@@ -94,7 +186,8 @@ class Document(DocumentBase):
     @classmethod
     async def load(cls, db, key, update=True):
         db = getattr(db, cls.collection)
-        document = await db.find_one({cls.pk: key})
+        with mongo_timer(cls.collection, "load"):
+            document = await db.find_one({cls.pk: key})
         if document:
             document = cls(document)
         else:
@@ -102,7 +195,8 @@ class Document(DocumentBase):
         return document
 
     @classmethod
-    async def find(cls, db, query=None, sort=True, **kwargs):
+    async def find(cls, db, query=None, sort=True, max_time_ms=None,
+                   **kwargs):
         db = getattr(db, cls.collection)
         if query is None:
             query = {}
@@ -116,9 +210,12 @@ class Document(DocumentBase):
                                  "lastmodified": 0})
         if sort and cls.default_sort:
             cursor.sort(cls.default_sort, 1)
+        if max_time_ms:
+            cursor.max_time_ms(max_time_ms)
 
-        async for doc in cursor:
-            result.append(cls(doc))
+        with mongo_timer(cls.collection, "find"):
+            async for doc in cursor:
+                result.append(cls(doc))
         return result
 
     async def save(self, db, upsert=True, user=None, **kw):
@@ -130,29 +227,77 @@ class Document(DocumentBase):
         owners = self.get("owner", [])
         if user and not owners:
             dict.__setitem__(self, 'owner', [user])
-        if not self.pk:
-            await db.insert(dict(self), **kw)
-        else:
-            await db.update({self.pk: self.id}, {'$set': self},
-                            upsert=upsert, **kw)
+        with mongo_timer(self.collection, "save"):
+            if not self.pk:
+                await db.insert(dict(self), **kw)
+            else:
+                await db.update({self.pk: self.id}, self.update_spec(),
+                                upsert=upsert, **kw)
+        if self.pk:
+            changes.publish(self.collection, self.id, changes.SAVE)
+
+    def update_spec(self):
+        """$set everything, but bump rather than overwrite the version
+
+        Every write increments version so it can serve as an ETag for
+        optimistic concurrency (see RESTResource.patch).
+        """
+        doc = dict(self)
+        spec = {'$set': doc}
+        if self.versioned():
+            doc.pop('version', None)
+            spec['$inc'] = {'version': 1}
+        return spec
+
+    @classmethod
+    def versioned(cls):
+        return 'version' in cls.schema['properties']
 
     async def remove(self, db):
         db = getattr(db, self.collection)
-        await db.remove({self.pk: self.id})
+        with mongo_timer(self.collection, "remove"):
+            await db.remove({self.pk: self.id})
+        changes.publish(self.collection, self.id, changes.REMOVE)
 
     @classmethod
     def text_fields(cls):
+        """String fields worth a full text search
+
+        Strings constrained by a pattern (hashes, shas) are identifiers,
+        not words, and are left out.
+        """
         return [f for f in cls.properties() if
-                cls.get_property(f)['type'] == "string"]
+                cls.get_property(f)['type'] == "string" and
+                'pattern' not in cls.get_property(f)]
+
+    @classmethod
+    async def drop_text_index(cls, db):
+        try:
+            await db.drop_index("fts")
+        except OperationFailure:
+            # already gone, e.g. another worker dropped it first
+            pass
 
     @classmethod
     async def create_text_index(cls, db, drop=False):
         db = getattr(db, cls.collection)
         if drop:
-            await db.drop_index("fts")
+            await cls.drop_text_index(db)
 
         fields = cls.text_fields()
         spec = []
         for field in fields:
             spec.append((field, motor.pymongo.TEXT))
-        await db.ensure_index(spec, name="fts")
+        try:
+            await db.ensure_index(spec, name="fts")
+        except OperationFailure:
+            # the schema's string fields changed since the index was built
+            log.info("Rebuilding text index of %s", cls.collection)
+            await cls.drop_text_index(db)
+            try:
+                await db.ensure_index(spec, name="fts")
+            except OperationFailure:
+                # workers bootstrapping at once race on the rebuild; one
+                # of them builds it, the rest carry on
+                log.warning("Unable to rebuild text index of %s",
+                            cls.collection, exc_info=True)
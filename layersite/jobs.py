@@ -0,0 +1,254 @@
+import asyncio
+import datetime
+import logging
+import os
+import socket
+import uuid
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from . import document
+from . import stats
+
+log = logging.getLogger("layersite")
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+jobs_total = stats.registry.counter(
+        "layersite_jobs_total",
+        "Ingest job attempts by outcome",
+        ("outcome",))
+
+
+class IngestJob(document.Document):
+    """A request to (re)ingest the repo of a layer
+
+    While a job is pending its `key` is the layer id. The unique index on
+    key means there is at most one pending job per layer, so repeated
+    enqueues coalesce. Claiming a job clears the key so edits made while
+    it runs queue a fresh job.
+    """
+    collection = "jobs"
+    schema = document.loader("job.schema")
+    pk = "id"
+    default_sort = "created"
+    # finished jobs are kept this long for inspection
+    retention = datetime.timedelta(days=7)
+
+    @classmethod
+    async def prepare(cls, db):
+        await super(IngestJob, cls).prepare(db)
+        db = getattr(db, cls.collection)
+        await db.ensure_index("id", name="id", unique=True)
+        await db.ensure_index("key", name="coalesce",
+                              unique=True, sparse=True)
+        await db.ensure_index([("state", 1), ("not_before", 1)],
+                              name="claim")
+        await db.ensure_index("finished", name="retention",
+                              expireAfterSeconds=int(
+                                  cls.retention.total_seconds()))
+
+
+class JobQueue:
+    """Mongo backed work queue with leases and retry backoff
+
+    Every worker process may run a handful of consumers. A consumer claims
+    the oldest runnable job by atomically moving it to running with a
+    lease; the lease is renewed while the handler runs so a crashed
+    process only delays its jobs until the lease runs out.
+    """
+    LEASE = 300
+    POLL_INTERVAL = 5
+    MAX_ATTEMPTS = 5
+    BACKOFF = 30
+    MAX_BACKOFF = 60 * 60
+    RENEW_RETRY = 5
+
+    def __init__(self, app, handler, workers=2):
+        self.app = app
+        self.handler = handler
+        self.workers = workers
+        self.worker_id = "{}:{}".format(socket.gethostname(), os.getpid())
+        self.wakeup = asyncio.Event(loop=app.loop)
+        self.tasks = []
+
+    @property
+    def collection(self):
+        return getattr(self.app['db'], IngestJob.collection)
+
+    def start(self):
+        for i in range(self.workers):
+            self.tasks.append(self.app.loop.create_task(self.consume()))
+
+    async def stop(self):
+        """Cancel the consumers, handing back the jobs they were running"""
+        tasks, self.tasks = self.tasks, []
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, loop=self.app.loop,
+                             return_exceptions=True)
+
+    async def enqueue(self, layer_id, reason=None):
+        """Queue an ingest for layer_id, returning the pending job"""
+        now = datetime.datetime.utcnow()
+        try:
+            job = await self.collection.find_one_and_update(
+                    {"key": layer_id},
+                    {"$setOnInsert": {"id": uuid.uuid4().hex,
+                                      "layer": layer_id,
+                                      "state": PENDING,
+                                      "attempts": 0,
+                                      "reason": reason or "",
+                                      "created": now,
+                                      "not_before": now}},
+                    upsert=True,
+                    return_document=ReturnDocument.AFTER)
+        except DuplicateKeyError:
+            # lost an upsert race, the winner is the pending job
+            job = await self.collection.find_one({"key": layer_id})
+        self.wakeup.set()
+        return job
+
+    async def claim(self):
+        now = datetime.datetime.utcnow()
+        return await self.collection.find_one_and_update(
+                {"$or": [{"state": PENDING, "not_before": {"$lte": now}},
+                         {"state": RUNNING, "lease_expires": {"$lt": now}}]},
+                {"$set": {"state": RUNNING,
+                          "worker": self.worker_id,
+                          "started": now,
+                          "lease_expires": now + datetime.timedelta(
+                              seconds=self.LEASE)},
+                 "$unset": {"key": ""},
+                 "$inc": {"attempts": 1}},
+                sort=[("not_before", 1)],
+                return_document=ReturnDocument.AFTER)
+
+    async def renew(self, job):
+        delay = self.LEASE / 3
+        while True:
+            await asyncio.sleep(delay)
+            expires = datetime.datetime.utcnow() + datetime.timedelta(
+                    seconds=self.LEASE)
+            try:
+                await self.collection.update(
+                        {"id": job["id"], "worker": self.worker_id},
+                        {"$set": {"lease_expires": expires}})
+                delay = self.LEASE / 3
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                # keep trying well inside the lease, once it lapses
+                # another worker may claim the job while it still runs
+                log.exception("Unable to renew lease of job %s", job["id"])
+                delay = self.RENEW_RETRY
+
+    def backoff(self, attempts):
+        return min(self.BACKOFF * 2 ** (attempts - 1), self.MAX_BACKOFF)
+
+    async def finish(self, job):
+        await self.collection.update(
+                {"id": job["id"], "worker": self.worker_id},
+                {"$set": {"state": DONE,
+                          "finished": datetime.datetime.utcnow(),
+                          "last_error": ""},
+                 "$unset": {"lease_expires": ""}})
+        jobs_total.inc(DONE)
+
+    async def fail(self, job, error):
+        now = datetime.datetime.utcnow()
+        update = {"last_error": error}
+        if job["attempts"] < self.MAX_ATTEMPTS:
+            delay = self.backoff(job["attempts"])
+            update.update(state=PENDING, key=job["layer"],
+                          not_before=now + datetime.timedelta(seconds=delay))
+            try:
+                await self.collection.update(
+                        {"id": job["id"], "worker": self.worker_id},
+                        {"$set": update, "$unset": {"lease_expires": ""}})
+                jobs_total.inc("retry")
+                log.info("Ingest of %s failed, retrying in %ds",
+                         job["layer"], delay)
+                return
+            except DuplicateKeyError:
+                # a newer job for the layer is already pending
+                update.update(last_error="superseded: " + error)
+                del update["key"]
+                del update["not_before"]
+        update.update(state=FAILED, finished=now)
+        await self.collection.update(
+                {"id": job["id"], "worker": self.worker_id},
+                {"$set": update, "$unset": {"lease_expires": ""}})
+        jobs_total.inc(FAILED)
+        log.warning("Ingest of %s failed: %s", job["layer"], error)
+
+    async def release(self, job):
+        """Return a job interrupted by shutdown to the queue, uncounted"""
+        try:
+            await self.collection.update(
+                    {"id": job["id"], "worker": self.worker_id},
+                    {"$set": {"state": PENDING, "key": job["layer"],
+                              "not_before": datetime.datetime.utcnow()},
+                     "$unset": {"lease_expires": ""},
+                     "$inc": {"attempts": -1}})
+        except DuplicateKeyError:
+            # a newer job for the layer is already pending
+            await self.collection.remove(
+                    {"id": job["id"], "worker": self.worker_id})
+
+    async def run(self, job):
+        renewer = self.app.loop.create_task(self.renew(job))
+        try:
+            await self.handler(self.app, job)
+        except asyncio.CancelledError:
+            try:
+                await self.release(job)
+            except Exception:
+                # the lease runs out instead, shutdown goes on regardless
+                log.exception("Unable to release job %s", job["id"])
+            raise
+        except Exception as e:
+            log.debug("Job %s failed", job["id"], exc_info=True)
+            await self.fail(job, "{}: {}".format(type(e).__name__, e))
+        else:
+            await self.finish(job)
+        finally:
+            renewer.cancel()
+
+    async def consume(self):
+        while True:
+            try:
+                job = await self.claim()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception("Unable to claim ingest jobs")
+                job = None
+            if job is None:
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(),
+                                           self.POLL_INTERVAL,
+                                           loop=self.app.loop)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            try:
+                await self.run(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                # recording the outcome failed; the lease runs out and
+                # the job is claimed again, this consumer carries on
+                log.exception("Unable to record outcome of job %s",
+                              job["id"])
+
+    async def status(self):
+        counts = {}
+        for state in (PENDING, RUNNING, DONE, FAILED):
+            counts[state] = await self.collection.count({"state": state})
+        return counts
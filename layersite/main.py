@@ -1,6 +1,14 @@
 import argparse
 import json
 import logging
+import os
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import time
+from pathlib import Path
 
 from aiohttp import web
 import aiohttp_jinja2
@@ -10,34 +18,65 @@ import jinja2
 from motor import motor_asyncio as motor
 
 
+from . import admission
 from . import model
+from . import parsing
+from . import stats
 from . import views
 
 
 log = logging.getLogger("layersite")
 
 
-async def init(options, loop):
-    mclient = motor.AsyncIOMotorClient(options.mongo_uri)
-    db = getattr(mclient, options.mongo_db)
+async def init(options, loop, db=None):
+    with stats.startup_phase("mongo_client"):
+        if db is None:
+            mclient = motor.AsyncIOMotorClient(options.mongo_uri)
+            db = getattr(mclient, options.mongo_db)
     app = web.Application(loop=loop)
     app.update(dict(options=options,
                     db=db))
-    loader = jinja2.PackageLoader("layersite", "templates")
-    env = aiohttp_jinja2.setup(app, loader=loader)
-    env.filters['jsonify'] = json.dumps
-    views.setup_routes(app, options)
-    await model.register_apis(app)
+    parsing.configure(
+            getattr(options, "parse_executor", "thread"),
+            getattr(options, "parse_workers", 2),
+            getattr(options, "parse_max_size", parsing.Parser.MAX_SIZE))
+    app['admission'] = admission.configure(options)
+    with stats.startup_phase("templates"):
+        loader = jinja2.FileSystemLoader(
+                str(Path(__file__).parent / "templates"))
+        env = aiohttp_jinja2.setup(app, loader=loader)
+        env.filters['jsonify'] = json.dumps
+    with stats.startup_phase("routes"):
+        views.setup_routes(app, options)
+    with stats.startup_phase("apis"):
+        await model.register_apis(app)
+    app['loop_monitor'] = loop.create_task(stats.monitor_loop_lag(loop))
+    if getattr(options, "stats_dir", None):
+        app['stats_publisher'] = loop.create_task(stats.publish_snapshots(
+            stats.snapshot_path(options.stats_dir, options.worker)))
+    app.on_shutdown.append(stop_background_tasks)
+    log.info("Startup: %s", stats.startup_report())
     return app
 
 
+async def stop_background_tasks(app):
+    """Cancel the sweeps, compaction, loop monitor and job consumers"""
+    tasks = [app[name] for name in ("loop_monitor", "repo_watcher",
+                                    "metrics_compaction", "stats_publisher")
+             if name in app]
+    for task in tasks:
+        task.cancel()
+    await app['jobs'].stop()
+    await asyncio.gather(*tasks, loop=app.loop, return_exceptions=True)
+
+
 def configure_logging(level):
     logging.basicConfig(level=level,
                         format="%(name)s:%(lineno)d:%(funcName)s: %(message)s")
     logging.getLogger("asyncio").setLevel(logging.WARN)
 
 
-def setup():
+def setup(args=None):
     parser = argparse.ArgumentParser()
     parser.add_argument("--mongo-uri", default="mongodb://localhost:27017")
     parser.add_argument("--mongo-db", default="layers")
@@ -45,21 +84,204 @@ def setup():
     parser.add_argument("-c", "--credentials", default="credentials.yaml")
     parser.add_argument("-l", "--log-level", default=logging.INFO)
 
-    options = parser.parse_args()
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("-p", "--port", type=int, default=8080)
+    parser.add_argument("-w", "--workers", type=int, default=1,
+                        help="Worker processes sharing the listening socket")
+    parser.add_argument("--backlog", type=int, default=128)
+    parser.add_argument("--debug", action="store_true",
+                        help="Enable asyncio debug mode (slow)")
+
+    parser.add_argument("--ingest-mode", default="tree",
+                        choices=["tree", "tarball", "contents"],
+                        help="How repos are fetched from Github: the "
+                             "recursive git tree plus changed blobs, a "
+                             "single tarball, or one contents call per file")
+    parser.add_argument("--parse-executor", default="thread",
+                        choices=["thread", "process"],
+                        help="Pool used to parse ingested YAML off the loop")
+    parser.add_argument("--parse-workers", type=int, default=2)
+    parser.add_argument("--parse-max-size", type=int,
+                        default=parsing.Parser.MAX_SIZE,
+                        help="Ingested files larger than this are skipped")
+    parser.add_argument("--ingest-workers", type=int, default=2,
+                        help="Concurrent repo ingest jobs per process")
+    parser.add_argument("--search-concurrency", type=int,
+                        default=admission.Admission.CONCURRENCY,
+                        help="Concurrent full text searches per route "
+                             "and process")
+    parser.add_argument("--search-queue", type=int,
+                        default=admission.Admission.QUEUE,
+                        help="Searches allowed to wait for a slot before "
+                             "further ones get 503")
+    parser.add_argument("--search-wait", type=float,
+                        default=admission.Admission.WAIT,
+                        help="Seconds a search may wait for a slot")
+    parser.add_argument("--search-rate", type=float,
+                        default=admission.Admission.RATE,
+                        help="Searches per second per client, 0 disables "
+                             "per client limits")
+    parser.add_argument("--search-burst", type=int,
+                        default=admission.Admission.BURST)
+    parser.add_argument("--query-timeout-ms", type=int,
+                        default=admission.Admission.MAX_TIME_MS,
+                        help="Mongo deadline for search queries")
+    parser.add_argument("--stats-token", default=None,
+                        help="Bearer token allowed to read /api/v2/_stats")
+    parser.add_argument("--metrics-retention-days", type=int, default=90,
+                        help="Days raw metric events are kept")
+    parser.add_argument("--metrics-compact-after-days", type=int, default=7,
+                        help="Age at which raw metrics are downsampled")
+
+    options = parser.parse_args(args)
     return options
 
 
-def main():
-    options = setup()
-    configure_logging(options.log_level)
-    loop = asyncio.get_event_loop()
-    loop.set_debug(True)
+def use_uvloop():
+    try:
+        import uvloop
+    except ImportError:
+        return False
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    return True
+
+
+def bind_socket(host, port, backlog=128):
+    """Bind the listening socket once so every worker can accept on it"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.setblocking(False)
+    return sock
+
+
+def serve(options, sock, worker=0):
+    """Run a single worker until SIGINT/SIGTERM
+
+    Only the primary worker, worker 0, runs the singleton background tasks
+    (see api.is_primary).
+    """
+    primary = worker == 0
+    options.primary = primary
+    options.worker = worker
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.set_debug(options.debug)
     app = loop.run_until_complete(init(options, loop))
+    handler = app.make_handler()
+    server = loop.run_until_complete(loop.create_server(handler, sock=sock))
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, loop.stop)
+    log.info("Worker %d serving on %s:%d%s", os.getpid(), options.host,
+             options.port, " (primary)" if primary else "")
     try:
-        web.run_app(app)
+        loop.run_forever()
     finally:
+        server.close()
+        loop.run_until_complete(server.wait_closed())
+        loop.run_until_complete(app.shutdown())
+        loop.run_until_complete(handler.finish_connections(60.0))
+        loop.run_until_complete(app.cleanup())
         loop.close()
 
 
+# a worker exiting sooner than this after its start counts as a crash
+# at startup; restarts after those back off, and too many in a row stop
+# the server instead of fork looping (e.g. while Mongo is unreachable)
+FAST_EXIT = 10
+MAX_FAST_EXITS = 5
+MAX_RESTART_DELAY = 30
+
+
+def supervise(options, sock):
+    """Fork options.workers children and restart any that die
+
+    Worker 0 is the primary; if it exits it is replaced by a new primary
+    so exactly one process ever runs the background sweeps. Returns the
+    exit status for the server.
+
+    Workers share the listening socket, so any of them may answer a
+    /api/v2/_stats scrape; they exchange stats snapshots through a
+    temporary directory so the answer covers all of them.
+    """
+    options.stats_dir = tempfile.mkdtemp(prefix="layersite-stats-")
+    workers = {}
+    started = {}
+    fast_exits = {}
+    stopping = False
+    status = 0
+
+    def spawn(index):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            code = 0
+            try:
+                serve(options, sock, worker=index)
+            except Exception:
+                log.exception("Worker %d failed", os.getpid())
+                code = 1
+            finally:
+                os._exit(code)
+        workers[pid] = index
+        started[index] = time.monotonic()
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    for index in range(options.workers):
+        spawn(index)
+
+    while workers:
+        try:
+            pid, exit_status = os.wait()
+        except InterruptedError:
+            continue
+        except ChildProcessError:
+            break
+        index = workers.pop(pid, None)
+        if index is None or stopping:
+            continue
+        if time.monotonic() - started[index] < FAST_EXIT:
+            fast_exits[index] = fast_exits.get(index, 0) + 1
+        else:
+            fast_exits[index] = 0
+        if fast_exits[index] >= MAX_FAST_EXITS:
+            log.error("Worker %d exited %d times right after starting, "
+                      "shutting down", index, fast_exits[index])
+            status = 1
+            stop(None, None)
+            continue
+        delay = min(2 ** fast_exits[index] - 1, MAX_RESTART_DELAY)
+        log.warning("Worker %d exited with status %d, restarting in %ds",
+                    pid, exit_status, delay)
+        time.sleep(delay)
+        if not stopping:
+            spawn(index)
+    shutil.rmtree(options.stats_dir, ignore_errors=True)
+    return status
+
+
+def main():
+    options = setup()
+    configure_logging(options.log_level)
+    if use_uvloop():
+        log.info("Using uvloop")
+    sock = bind_socket(options.host, options.port, options.backlog)
+    if options.workers > 1:
+        return supervise(options, sock)
+    serve(options, sock)
+
+
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
@@ -0,0 +1,374 @@
+import asyncio
+import datetime
+import logging
+import time
+
+from pymongo.errors import OperationFailure
+from strict_rfc3339 import rfc3339_to_timestamp, InvalidRFC3339Error
+
+from . import document
+
+log = logging.getLogger("layersite")
+
+HOUR = "hour"
+DAY = "day"
+GRANULARITIES = (HOUR, DAY)
+
+
+def bucket_start(when, granularity):
+    """Truncate a datetime to the start of its hour or day bucket"""
+    if granularity == HOUR:
+        return when.replace(minute=0, second=0, microsecond=0)
+    elif granularity == DAY:
+        return when.replace(hour=0, minute=0, second=0, microsecond=0)
+    raise ValueError("Unknown granularity {}".format(granularity))
+
+
+def bucket_step(granularity):
+    if granularity == HOUR:
+        return datetime.timedelta(hours=1)
+    elif granularity == DAY:
+        return datetime.timedelta(days=1)
+    raise ValueError("Unknown granularity {}".format(granularity))
+
+
+def counter_key(value):
+    """Mongo field names can't contain '.' or start with '$'"""
+    value = str(value or "-")
+    value = value.replace(".", "\uff0e")
+    if value.startswith("$"):
+        value = "\uff04" + value[1:]
+    return value
+
+
+def counter_value(key):
+    return key.replace("\uff0e", ".").replace("\uff04", "$")
+
+
+async def ensure_ttl_index(collection, field, seconds, name):
+    """Create a TTL index or adjust the expiry of an existing one"""
+    try:
+        await collection.ensure_index(field, name=name,
+                                      expireAfterSeconds=seconds)
+    except OperationFailure:
+        # ensure_index refuses to change options on an existing index
+        await collection.database.command(
+                "collMod", collection.name,
+                index={"keyPattern": {field: 1},
+                       "expireAfterSeconds": seconds})
+
+
+# One built in Document kind we manage
+class Metric(document.Document):
+    collection = "metrics"
+    schema = document.loader("metrics.schema")
+    pk = None
+    default_sort = None
+    # Raw events are removed by Mongo this long after their timestamp
+    retention = datetime.timedelta(days=90)
+    # and are downsampled into MetricSummary documents once this old
+    compact_after = datetime.timedelta(days=7)
+
+    @classmethod
+    def configure(cls, retention_days=None, compact_after_days=None):
+        if retention_days is not None:
+            cls.retention = datetime.timedelta(days=retention_days)
+        if compact_after_days is not None:
+            cls.compact_after = datetime.timedelta(days=compact_after_days)
+        if cls.compact_after >= cls.retention:
+            raise ValueError("Metrics must be compacted before they expire "
+                             "(compact after {} >= retention {})".format(
+                                 cls.compact_after, cls.retention))
+
+    @classmethod
+    async def prepare(cls, db):
+        await super(Metric, cls).prepare(db)
+        await ensure_ttl_index(getattr(db, cls.collection), "timestamp",
+                               int(cls.retention.total_seconds()),
+                               name="retention")
+
+
+class MetricRollup(document.Document):
+    """Pre-aggregated metric counters
+
+    There is one document per (granularity, start, kind, action). Each
+    holds a total count and per item and per username counters so time
+    series and top-N queries read a handful of documents per bucket rather
+    than the raw event stream.
+    """
+    collection = "metrics_rollup"
+    schema = document.loader("metrics_rollup.schema")
+    pk = None
+    default_sort = "start"
+
+    @classmethod
+    async def prepare(cls, db):
+        db = getattr(db, cls.collection)
+        await db.ensure_index([("granularity", 1),
+                               ("start", 1),
+                               ("kind", 1),
+                               ("action", 1)],
+                              name="bucket", unique=True)
+        # Only hourly buckets carry expire_at; daily ones are kept
+        await db.ensure_index("expire_at", name="retention",
+                              expireAfterSeconds=0)
+
+    @classmethod
+    async def record(cls, db, data, when=None, **kw):
+        """Increment the hourly and daily counters for a metric event"""
+        if when is None:
+            when = datetime.datetime.utcnow()
+        db = getattr(db, cls.collection)
+        inc = {"count": 1,
+               "items.{}".format(counter_key(data.get("item"))): 1,
+               "users.{}".format(counter_key(data.get("username"))): 1,
+               }
+        for granularity in GRANULARITIES:
+            key = {"granularity": granularity,
+                   "start": bucket_start(when, granularity),
+                   "kind": data.get("kind", ""),
+                   "action": data.get("action", ""),
+                   }
+            update = {"$inc": inc}
+            if granularity == HOUR:
+                update["$setOnInsert"] = {
+                        "expire_at": key["start"] + Metric.retention}
+            await db.update(key, update, upsert=True, **kw)
+
+    @classmethod
+    async def buckets(cls, db, granularity, start, end,
+                      kind=None, action=None):
+        db = getattr(db, cls.collection)
+        query = {"granularity": granularity,
+                 "start": {"$gte": bucket_start(start, granularity),
+                           "$lt": end}}
+        if kind:
+            query["kind"] = kind
+        if action:
+            query["action"] = action
+        cursor = db.find(query, {"_id": 0})
+        cursor.sort("start", 1)
+        result = []
+        async for doc in cursor:
+            result.append(doc)
+        return result
+
+    @classmethod
+    async def series(cls, db, granularity, start, end,
+                     kind=None, action=None, item=None, username=None):
+        """Return [{start, count}] for every bucket in [start, end)"""
+        if item and username:
+            # buckets count items and users separately, not pairs
+            raise ValueError("Can only filter by item or username")
+        counts = {}
+        for doc in await cls.buckets(db, granularity, start, end,
+                                     kind, action):
+            if item:
+                value = doc.get("items", {}).get(counter_key(item), 0)
+            elif username:
+                value = doc.get("users", {}).get(counter_key(username), 0)
+            else:
+                value = doc.get("count", 0)
+            counts[doc["start"]] = counts.get(doc["start"], 0) + value
+
+        result = []
+        step = bucket_step(granularity)
+        current = bucket_start(start, granularity)
+        while current < end:
+            result.append({"start": current, "count": counts.get(current, 0)})
+            current += step
+        return result
+
+    @classmethod
+    async def top(cls, db, field, granularity, start, end,
+                  kind=None, action=None, limit=10):
+        """Return the `limit` most frequent items or users in [start, end)"""
+        if field == "item":
+            attr = "items"
+        elif field == "username":
+            attr = "users"
+        else:
+            raise ValueError("Can only rank by item or username")
+        if limit < 1:
+            raise ValueError("limit must be at least 1")
+        totals = {}
+        for doc in await cls.buckets(db, granularity, start, end,
+                                     kind, action):
+            for key, value in doc.get(attr, {}).items():
+                totals[key] = totals.get(key, 0) + value
+        ranked = sorted(totals.items(), key=lambda kv: (-kv[1], kv[0]))
+        return [{field: counter_value(k), "count": v}
+                for k, v in ranked[:limit]]
+
+
+class MetricSummary(document.Document):
+    """Daily downsample of raw Metric events
+
+    Written by MetricCompactor before the raw events expire. There is one
+    document per (day, kind, action, item).
+    """
+    collection = "metrics_summary"
+    schema = document.loader("metrics_summary.schema")
+    pk = None
+    default_sort = "day"
+
+    @classmethod
+    async def prepare(cls, db):
+        db = getattr(db, cls.collection)
+        await db.ensure_index([("day", 1),
+                               ("kind", 1),
+                               ("action", 1),
+                               ("item", 1)],
+                              name="summary", unique=True)
+
+
+class MetricCompactor:
+    """Background task downsampling raw metrics a day at a time
+
+    Progress is kept in a single state document so compaction resumes
+    where it left off after a restart. Each day is summarised completely
+    in memory and then written with $set, so re-running a day (after a
+    crash for example) is harmless.
+    """
+    collection = "metrics_compaction"
+    INTERVAL = 60 * 60
+    MIGRATE_BATCH = 500
+
+    def __init__(self, db):
+        self.db = db
+        self.state_id = "compactor"
+
+    @property
+    def state_collection(self):
+        return getattr(self.db, self.collection)
+
+    @property
+    def raw(self):
+        return getattr(self.db, Metric.collection)
+
+    async def state(self):
+        state = await self.state_collection.find_one({"_id": self.state_id})
+        return state or {"_id": self.state_id}
+
+    async def set_state(self, **kwargs):
+        await self.state_collection.update({"_id": self.state_id},
+                                           {"$set": kwargs}, upsert=True)
+
+    async def run(self, interval=None):
+        interval = interval or self.INTERVAL
+        while True:
+            try:
+                await self.compact()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.exception("Metric compaction failed")
+                await self.set_state(last_error=str(e),
+                                     last_run=datetime.datetime.utcnow())
+            await asyncio.sleep(interval)
+
+    async def migrate_timestamps(self):
+        """Convert legacy RFC3339 string timestamps to dates
+
+        TTL indexes ignore documents whose field is not a date, so events
+        recorded before retention was introduced would never expire.
+        """
+        migrated = 0
+        while True:
+            cursor = self.raw.find({"timestamp": {"$type": "string"}},
+                                   {"timestamp": 1})
+            cursor.limit(self.MIGRATE_BATCH)
+            batch = 0
+            async for doc in cursor:
+                batch += 1
+                try:
+                    when = datetime.datetime.utcfromtimestamp(
+                            rfc3339_to_timestamp(doc["timestamp"]))
+                except InvalidRFC3339Error:
+                    # Unparseable, let it age out from now
+                    when = datetime.datetime.utcnow()
+                await self.raw.update({"_id": doc["_id"]},
+                                      {"$set": {"timestamp": when}})
+            migrated += batch
+            if batch < self.MIGRATE_BATCH:
+                return migrated
+
+    async def oldest_event(self):
+        cursor = self.raw.find({"timestamp": {"$type": "date"}},
+                               {"timestamp": 1})
+        cursor.sort("timestamp", 1).limit(1)
+        async for doc in cursor:
+            return doc["timestamp"]
+        return None
+
+    async def compact_day(self, day):
+        end = day + datetime.timedelta(days=1)
+        counts = {}
+        cursor = self.raw.find({"timestamp": {"$gte": day, "$lt": end}},
+                               {"kind": 1, "action": 1, "item": 1,
+                                "username": 1})
+        events = 0
+        async for doc in cursor:
+            events += 1
+            key = (doc.get("kind", ""), doc.get("action", ""),
+                   doc.get("item", ""))
+            entry = counts.setdefault(key, {"count": 0, "users": set()})
+            entry["count"] += 1
+            if doc.get("username"):
+                entry["users"].add(doc["username"])
+
+        summaries = getattr(self.db, MetricSummary.collection)
+        for (kind, action, item), entry in counts.items():
+            await summaries.update(
+                    {"day": day, "kind": kind,
+                     "action": action, "item": item},
+                    {"$set": {"count": entry["count"],
+                              "unique_users": len(entry["users"])}},
+                    upsert=True)
+        return events
+
+    async def compact(self):
+        started = time.monotonic()
+        state = await self.state()
+        migrated = await self.migrate_timestamps()
+
+        now = datetime.datetime.utcnow()
+        cutoff = bucket_start(now - Metric.compact_after, DAY)
+        day = state.get("watermark")
+        if day is None:
+            oldest = await self.oldest_event()
+            day = bucket_start(oldest, DAY) if oldest else cutoff
+
+        events = 0
+        days = 0
+        while day < cutoff:
+            events += await self.compact_day(day)
+            days += 1
+            day += datetime.timedelta(days=1)
+            # persist per day so progress survives restarts
+            await self.set_state(watermark=day)
+
+        duration = time.monotonic() - started
+        await self.set_state(
+                watermark=day,
+                last_run=now,
+                last_duration=duration,
+                last_days=days,
+                last_events=events,
+                last_error=None,
+                events_total=state.get("events_total", 0) + events,
+                migrated_total=state.get("migrated_total", 0) + migrated)
+        if days or migrated:
+            log.info("Compacted %d metric events over %d days "
+                     "(%d timestamps migrated) in %.2fs",
+                     events, days, migrated, duration)
+
+    async def status(self):
+        state = await self.state()
+        state.pop("_id", None)
+        return {"retention_days": Metric.retention.days,
+                "compact_after_days": Metric.compact_after.days,
+                "raw_events": await self.raw.count(),
+                "oldest_event": await self.oldest_event(),
+                "compaction": state,
+                }
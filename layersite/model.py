@@ -1,15 +1,26 @@
 import asyncio
-import base64
+import datetime
+import hashlib
 import json
 import logging
-import yaml
+import io
+import tarfile
+import time
 
 from aiohttp import web
-from pathlib import Path
+from pathlib import Path, PurePosixPath
+from strict_rfc3339 import (rfc3339_to_timestamp, InvalidRFC3339Error)
 from urllib.parse import urlparse
 
-from .api import (RESTCollection, RESTResource, Metric, dump)
+from .api import (RESTCollection, RESTResource, Metric, dump, etag,
+                  is_primary)
 from . import auth
+from . import blobs
+from . import changes
+from . import jobs
+from . import metrics
+from . import parsing
+from . import stats
 from .document import Document, loader
 
 log = logging.getLogger("layersite")
@@ -39,6 +50,39 @@ class SchemaAPI:
                             headers={'Content-Type': 'application/json'})
 
 
+class StatsAPI:
+    """Process statistics in the Prometheus text exposition format
+
+    Available to admin users or to scrapers presenting the configured
+    --stats-token as a bearer token. With --workers every sample carries
+    a worker label; other workers' samples are up to a few seconds old.
+    """
+    headers = {'Content-Type': 'text/plain; version=0.0.4'}
+
+    def __init__(self, registry=stats.registry):
+        self.registry = registry
+
+    def authorized(self, request):
+        token = getattr(request.app['options'], "stats_token", None)
+        if token and request.headers.get(
+                "Authorization") == "Bearer {}".format(token):
+            return True
+        user = auth.get_current_user(request)
+        return bool(user) and user['login'] in request.app['admin_users']
+
+    async def get(self, request):
+        if not self.authorized(request):
+            raise web.HTTPForbidden()
+        options = request.app['options']
+        registry = self.registry
+        if getattr(options, "stats_dir", None):
+            stats.write_snapshot(stats.snapshot_path(
+                options.stats_dir, options.worker), self.registry)
+            registry = stats.merge_snapshots(
+                    stats.read_snapshots(options.stats_dir))
+        return web.Response(text=registry.render(), headers=self.headers)
+
+
 class LayersAPI(RESTCollection):
     version = "v2"
     factory = Layer
@@ -46,9 +90,11 @@ class LayersAPI(RESTCollection):
 
     async def get(self):
         q = self.parse_search_query()
+        deadline = self.max_time_ms
         response = []
         seen = set()
-        for iface in (await self.factory.find(self.db, q)):
+        for iface in (await self.factory.find(self.db, q,
+                                              max_time_ms=deadline)):
             seen.add(iface.id)
             response.append(iface)
 
@@ -58,8 +104,19 @@ class LayersAPI(RESTCollection):
         if repotext:
             # Fall back to a full text search
             matched_repos = []
-            for repo in (await Repo.find(self.db, q)):
+            repos = await Repo.find(self.db, q, max_time_ms=deadline)
+            if "$text" in q:
+                # readmes live in blob storage, search them there
+                hashes = await blobs.Blob.search_text(
+                        self.db, q["$text"]["$search"], kind="readme",
+                        max_time_ms=deadline)
+                if hashes:
+                    repos.extend(await Repo.find(
+                        self.db, {"readme_blob": {"$in": hashes}},
+                        max_time_ms=deadline))
+            for repo in repos:
                 if repo.id not in seen:
+                    seen.add(repo.id)
                     matched_repos.append(repo.id)
             for did in matched_repos:
                 iface = await self.factory.find(self.db,
@@ -76,13 +133,13 @@ class LayerAPI(RESTResource):
     async def post(self, uid):
         result = await super(LayerAPI, self).post(uid)
         # and pull any repo updates
+        await self.app['jobs'].enqueue(uid.rstrip("/"), reason="update")
+        return result
 
-        uid = uid.rstrip("/")
-        doc = await self.factory.find(self.db, {'id': uid})
-        doc = doc[0]
-
-        repo = RepoAPI()
-        self.request.app.loop.create_task(repo.ingest_repo(self.app, doc))
+    async def patch(self, uid):
+        result = await super(LayerAPI, self).patch(uid)
+        # the patch may have pointed the layer at another repo
+        await self.app['jobs'].enqueue(uid.rstrip("/"), reason="update")
         return result
 
 
@@ -94,32 +151,59 @@ class RepoAPI(RESTResource):
 
     async def bootstrap(self, app, db):
         await (super(RepoAPI, self).bootstrap(app, db))
-        # and spawn a "cronjob" for inspecting repos
-        self.watcher = app.loop.create_task(self.watch_repos(app, db))
+        await blobs.Blob.prepare(db)
+        # and spawn a "cronjob" for inspecting repos, only once across
+        # all the worker processes
+        if is_primary(app):
+            self.watcher = app.loop.create_task(self.watch_repos(app, db))
+            app['repo_watcher'] = self.watcher
+
+    async def get(self, uid):
+        """GET a repo, ?expand=readme,rules,schema (or all) inlines blobs"""
+        expand = self.request.GET.get("expand")
+        if not expand:
+            return await super(RepoAPI, self).get(uid)
+        fields = {"readme", "rules", "schema"}
+        if expand not in ("1", "all"):
+            fields &= set(expand.split(","))
+        result = await self.factory.find(self.db, id=uid.rstrip("/"))
+        await blobs.expand(self.db, result, fields)
+        headers = self.headers
+        if result:
+            headers = dict(headers, ETag=etag(result[0].get("version", 1)))
+        return web.Response(text=dump(result[0] if result else []),
+                            headers=headers)
 
     async def watch_repos(self, app, db):
         while True:
-            # walk the collection of layers (yes, there is an encapsulation
-            # break here) and update their repos when needed
-            for layer in await Layer.find(db):
-                await self.ingest_repo(app, layer)
+            await self.sweep_repos(app, db)
             await asyncio.sleep(self.WATCH_INTERVAL)
 
-    def decode_content_from_response(self, response):
-        content = base64.b64decode(response['content'])
-        content = content.decode("utf-8")
-        return content
+    async def sweep_repos(self, app, db):
+        # walk the collection of layers (yes, there is an encapsulation
+        # break here) and queue updates of their repos
+        for layer in await Layer.find(db):
+            await app['jobs'].enqueue(layer.id, reason="sweep")
+
+    async def decode_content_from_response(self, response):
+        return await parsing.parser.base64(response['content'],
+                                           response.get('path'))
 
     async def get_readme(self, repo_url, ghclient):
         url = urlparse(repo_url)
         rpath = url.path
         response = await ghclient.get("/repos{}/readme".format(rpath))
-        return self.decode_content_from_response(response)
+        try:
+            return await self.decode_content_from_response(response)
+        except parsing.ContentTooLarge as e:
+            log.warning("Skipping readme of %s: %s", repo_url, e)
+            return ""
 
     async def get_content(self, url, ghclient):
         response = await ghclient.get(url)
-        content = self.decode_content_from_response(response)
-        response['content'] = content
+        content = await self.decode_content_from_response(response)
+        response['content'] = await parsing.parser.yaml(
+                content, response.get('path'))
         return response
 
     async def walk_content(self, repo_url, ghclient):
@@ -132,51 +216,427 @@ class RepoAPI(RESTResource):
             if item['type'] != "file":
                 continue
             path = Path(item['path'])
-            if path.match("*.rules"):
-                rules.append(
-                        await self.get_content(
-                            item['url'], ghclient))
-            elif path.match("*.schema"):
-                schemas.append(
-                    await self.get_content(
-                        item['url'], ghclient))
-
-        for rule in rules:
-            rule['content'] = yaml.load(rule['content'])
-        for schema in schemas:
-            schema['content'] = yaml.load(schema['content'])
+            target = self.classify(path, rules, schemas)
+            if target is None:
+                continue
+            try:
+                target.append(await self.get_content(item['url'], ghclient))
+            except parsing.ContentTooLarge as e:
+                log.warning("Skipping %s in %s: %s", path, repo_url, e)
         return rules, schemas
 
     async def ingest_repo(self, app, layer_doc):
+        outcome = "failure"
+        start = time.perf_counter()
+        try:
+            await self._ingest_repo(app, layer_doc)
+            outcome = "success"
+            changes.publish(Repo.collection, layer_doc['id'], changes.INGEST)
+        finally:
+            stats.ingest_total.inc(outcome)
+            stats.ingest_duration.observe(time.perf_counter() - start,
+                                          outcome)
+
+    async def _ingest_repo(self, app, layer_doc):
         oid = layer_doc['id']
         repo_url = layer_doc['repo']
+        mode = getattr(app['options'], "ingest_mode", "contents")
         gh = auth.get_github_client()
         if not gh:
             raise ValueError("Unable to obtains github client")
-        log.info("Ingesting %s for %s", repo_url, oid)
-        readme = await self.get_readme(repo_url, gh)
-        rules, schemas = await self.walk_content(repo_url, gh)
+        log.info("Ingesting %s for %s (%s)", repo_url, oid, mode)
+        db = app['db']
+        existing = await self.factory.load(db, oid)
+        try:
+            if mode == "contents":
+                readme = await self.get_readme(repo_url, gh)
+                rules, schemas = await self.walk_content(repo_url, gh)
+                data = {"readme": readme, "rules": rules, "schema": schemas}
+            else:
+                data = await self.fetch_snapshot(repo_url, gh, existing,
+                                                 mode)
+        finally:
+            gh.close()
+
+        data = await blobs.externalize(db, data, existing)
+        if all(existing.get(k) == v for k, v in data.items()) and \
+                "readme" not in existing:
+            log.debug("Repo %s unchanged", oid)
+            return
         obj = self.factory()
-        obj.update({"id": oid,
-                    "readme": readme,
-                    "rules": rules,
-                    "schema": schemas})
-        await obj.save(app['db'])
-        gh.close()
+        obj.update(data, id=oid)
+        await obj.save(db)
+        if "readme" in existing:
+            # drop the content embedded before blob storage
+            await getattr(db, self.factory.collection).update(
+                    {"id": oid}, {"$unset": {"readme": ""}})
+
+    # Snapshot ingestion: the whole repo in O(1) requests plus one blob
+    # fetch per changed file, instead of one request per file
+
+    @staticmethod
+    def git_blob_sha(data):
+        header = "blob {}\0".format(len(data)).encode("utf-8")
+        return hashlib.sha1(header + data).hexdigest()
+
+    @staticmethod
+    def is_readme(path):
+        return len(path.parts) == 1 and path.name.lower().startswith("readme")
+
+    @staticmethod
+    def classify(path, rules, schemas):
+        if path.match("*.rules"):
+            return rules
+        elif path.match("*.schema"):
+            return schemas
+        return None
+
+    async def make_item(self, path, sha, size, content):
+        return {"type": "file",
+                "name": path.name,
+                "path": str(path),
+                "sha": sha,
+                "size": size,
+                "content": await parsing.parser.yaml(content, str(path))}
+
+    async def get_blob(self, rpath, sha, ghclient):
+        response = await ghclient.get(
+                "/repos{}/git/blobs/{}".format(rpath, sha))
+        return await self.decode_content_from_response(response)
+
+    async def fetch_snapshot(self, repo_url, ghclient, existing, mode="tree"):
+        if mode == "tree":
+            snapshot = await self.walk_tree(repo_url, ghclient, existing)
+            if snapshot is not None:
+                return snapshot
+            log.info("Tree of %s is truncated, fetching tarball", repo_url)
+        return await self.walk_tarball(repo_url, ghclient)
+
+    async def walk_tree(self, repo_url, ghclient, existing):
+        """Ingest from the recursive git tree
+
+        Files whose blob sha matches the previously ingested copy are
+        reused without fetching them again. Returns None when Github
+        truncates the tree.
+        """
+        rpath = urlparse(repo_url).path
+        tree = await ghclient.get(
+                "/repos{}/git/trees/HEAD?recursive=1".format(rpath))
+        if tree.get("truncated"):
+            return None
+
+        known = {}
+        for item in existing.get("rules") or []:
+            known[item.get("path")] = item
+        for item in existing.get("schema") or []:
+            known[item.get("path")] = item
+        readme = ""
+        readme_sha = ""
+        readme_blob = None
+        rules = []
+        schemas = []
+        for entry in tree["tree"]:
+            if entry["type"] != "blob":
+                continue
+            path = PurePosixPath(entry["path"])
+            if self.is_readme(path):
+                if readme_sha:
+                    continue
+                readme_sha = entry["sha"]
+                if readme_sha == existing.get("readme_sha") and \
+                        existing.get("readme_blob"):
+                    readme = None
+                    readme_blob = existing["readme_blob"]
+                elif entry.get("size", 0) > parsing.parser.max_size:
+                    log.warning("Skipping %s in %s, too large",
+                                path, repo_url)
+                else:
+                    readme = await self.get_blob(rpath, readme_sha, ghclient)
+                continue
+            target = self.classify(path, rules, schemas)
+            if target is None:
+                continue
+            cached = known.get(entry["path"])
+            if cached and cached.get("sha") == entry["sha"]:
+                target.append(cached)
+                continue
+            try:
+                # the size guard applies before the blob is fetched
+                if entry.get("size", 0) > parsing.parser.max_size:
+                    raise parsing.ContentTooLarge("too large")
+                content = await self.get_blob(rpath, entry["sha"], ghclient)
+                target.append(await self.make_item(
+                    path, entry["sha"], entry.get("size", 0), content))
+            except parsing.ContentTooLarge as e:
+                log.warning("Skipping %s in %s: %s", path, repo_url, e)
+        snapshot = {"readme": readme, "readme_sha": readme_sha,
+                    "rules": rules, "schema": schemas}
+        if readme_blob:
+            snapshot["readme_blob"] = readme_blob
+        return snapshot
+
+    def read_tarball(self, fileobj, max_size):
+        """Decompress and select README, rules and schema members
+
+        Blocking, run in an executor thread by walk_tarball while the
+        archive is still downloading.
+        """
+        selected = []
+        with tarfile.open(fileobj=fileobj, mode="r|gz") as archive:
+            for member in archive:
+                if not member.isfile():
+                    continue
+                # members are prefixed with <owner>-<repo>-<commit>/
+                parts = member.name.split("/", 1)
+                if len(parts) != 2:
+                    continue
+                path = PurePosixPath(parts[1])
+                if not (self.is_readme(path) or
+                        self.classify(path, [], []) is not None):
+                    continue
+                if member.size > max_size:
+                    log.warning("Skipping %s, too large", member.name)
+                    continue
+                data = archive.extractfile(member).read()
+                selected.append((path, self.git_blob_sha(data), data))
+        return selected
+
+    async def walk_tarball(self, repo_url, ghclient):
+        """Ingest from a single tarball, streamed and filtered in memory
+
+        The download feeds read_tarball through a ChunkPipe, so only a
+        few chunks of the archive are held at any time and nothing is
+        written to disk.
+        """
+        rpath = urlparse(repo_url).path
+        readme = ""
+        readme_sha = ""
+        rules = []
+        schemas = []
+        pipe = ChunkPipe(asyncio.get_event_loop())
+        reader = asyncio.ensure_future(parsing.parser.run_blocking(
+                self.read_tarball, pipe, parsing.parser.max_size))
+        # a reader stopping early, done or failed, must not leave the
+        # download waiting on a full pipe
+        reader.add_done_callback(lambda f: pipe.abort())
+        try:
+            await ghclient.stream("/repos{}/tarball".format(rpath),
+                                  pipe.write)
+            await pipe.write(b"")
+        except BrokenPipeError:
+            # the reader finished first, its result tells what happened
+            pass
+        except BaseException:
+            reader.cancel()
+            pipe.abort()
+            raise
+        selected = await reader
+        for path, sha, data in selected:
+            text = data.decode("utf-8")
+            if self.is_readme(path):
+                if not readme_sha:
+                    readme, readme_sha = text, sha
+                continue
+            target = self.classify(path, rules, schemas)
+            target.append(await self.make_item(path, sha, len(data), text))
+        return {"readme": readme, "readme_sha": readme_sha,
+                "rules": rules, "schema": schemas}
+
+
+class ChunkPipe(io.RawIOBase):
+    """Blocking file object over chunks written on the event loop
+
+    The loop side awaits write(), which waits while the bounded queue is
+    full; the reader thread's reads fetch chunks from the loop. An empty
+    chunk marks the end of the stream.
+    """
+
+    def __init__(self, loop, maxsize=16):
+        super(ChunkPipe, self).__init__()
+        self.loop = loop
+        self.chunks = asyncio.Queue(maxsize, loop=loop)
+        self.pending = b""
+        self.eof = False
+        self.broken = False
+
+    async def write(self, chunk):
+        if self.broken:
+            raise BrokenPipeError("Reader of the stream has stopped")
+        await self.chunks.put(chunk)
+
+    def abort(self):
+        """From the loop: end the stream for the reader, break it for
+        the writer"""
+        self.broken = True
+        while not self.chunks.empty():
+            self.chunks.get_nowait()
+        self.chunks.put_nowait(b"")
+
+    def readable(self):
+        return True
+
+    def readinto(self, buf):
+        while not self.pending:
+            if self.eof:
+                return 0
+            chunk = asyncio.run_coroutine_threadsafe(
+                    self.chunks.get(), self.loop).result()
+            self.eof = not chunk
+            self.pending = chunk
+        n = min(len(buf), len(self.pending))
+        buf[:n] = self.pending[:n]
+        self.pending = self.pending[n:]
+        return n
+
+
+async def run_ingest_job(app, job):
+    """JobQueue handler ingesting the repo of the job's layer"""
+    layers = await Layer.find(app['db'], {'id': job['layer']})
+    if not layers:
+        raise ValueError("Layer {} no longer exists".format(job['layer']))
+    await RepoAPI().ingest_repo(app, layers[0])
+
+
+class JobsAPI(RESTCollection):
+    """Ingest job status
+
+    GET /api/v2/jobs/?q=layer:<id> or ?q=state:failed
+    GET /api/v2/jobs/?summary=1 for counts by state
+
+    Admin only.
+    """
+    version = "v2"
+    factory = jobs.IngestJob
+    endpoint = "jobs"
+    changes = False
+    importable = False
+
+    async def bootstrap(self, app, db):
+        await (super(JobsAPI, self).bootstrap(app, db))
+        app['jobs'].start()
+
+    async def get(self):
+        # jobs carry worker hosts and raw ingest errors
+        if not self.is_admin():
+            raise web.HTTPUnauthorized(reason="Admin access required")
+        if self.request.GET.get("summary"):
+            status = await self.app['jobs'].status()
+            return web.Response(text=dump(status), headers=self.headers)
+        return await super(JobsAPI, self).get()
+
+    async def post(self):
+        raise web.HTTPMethodNotAllowed("POST", ["GET"])
 
 
 class MetricsAPI(RESTCollection):
     version = "v2"
     factory = Metric
     endpoint = "metrics"
+    changes = False
+
+    async def bootstrap(self, app, db):
+        options = app['options']
+        Metric.configure(
+                retention_days=getattr(options, "metrics_retention_days",
+                                       None),
+                compact_after_days=getattr(options,
+                                           "metrics_compact_after_days",
+                                           None))
+        await (super(MetricsAPI, self).bootstrap(app, db))
 
     async def get(self):
-        user = self.get_current_user()
-        if not user or user['login'] not in self.request.app['admin_users']:
+        if not self.is_admin():
             return web.Response(text="[]", headers=self.headers)
         return await super(MetricsAPI, self).get()
 
 
+class MetricsRollupAPI(RESTCollection):
+    """Time series and top-N views over the pre-aggregated metrics
+
+    GET /api/v2/metrics/rollup/?granularity=hour&kind=layer&action=update
+    GET /api/v2/metrics/rollup/?granularity=day&top=item&limit=10
+
+    A series narrows to one item or one username, not both.
+    """
+    version = "v2"
+    factory = metrics.MetricRollup
+    endpoint = "metrics/rollup"
+    changes = False
+    importable = False
+    MAX_BUCKETS = 24 * 31
+
+    def parse_time(self, name, default):
+        value = self.request.GET.get(name)
+        if not value:
+            return default
+        try:
+            return datetime.datetime.utcfromtimestamp(
+                    rfc3339_to_timestamp(value))
+        except InvalidRFC3339Error:
+            raise web.HTTPBadRequest(
+                    reason="{} must be an RFC3339 timestamp".format(name))
+
+    async def get(self):
+        if not self.is_admin():
+            return web.Response(text="[]", headers=self.headers)
+
+        GET = self.request.GET
+        granularity = GET.get("granularity", metrics.HOUR)
+        if granularity not in metrics.GRANULARITIES:
+            raise web.HTTPBadRequest(reason="Unknown granularity")
+        step = metrics.bucket_step(granularity)
+        end = self.parse_time("end", datetime.datetime.utcnow())
+        start = self.parse_time("start", end - step * 24)
+        if start >= end or (end - start) / step > self.MAX_BUCKETS:
+            raise web.HTTPBadRequest(reason="Invalid time range")
+        kind = GET.get("kind")
+        action = GET.get("action")
+
+        top = GET.get("top")
+        try:
+            if top:
+                limit = int(GET.get("limit", 10))
+                response = await self.factory.top(
+                        self.db, top, granularity, start, end,
+                        kind=kind, action=action, limit=limit)
+            else:
+                response = await self.factory.series(
+                        self.db, granularity, start, end,
+                        kind=kind, action=action,
+                        item=GET.get("item"), username=GET.get("username"))
+        except ValueError as e:
+            raise web.HTTPBadRequest(reason=str(e))
+        return web.Response(text=dump(response), headers=self.headers)
+
+    async def post(self):
+        raise web.HTTPMethodNotAllowed("POST", ["GET"])
+
+
+class MetricsRetentionAPI(RESTCollection):
+    """Retention limits and compaction progress for raw metrics"""
+    version = "v2"
+    factory = metrics.MetricSummary
+    endpoint = "metrics/retention"
+    changes = False
+    importable = False
+
+    async def bootstrap(self, app, db):
+        await (super(MetricsRetentionAPI, self).bootstrap(app, db))
+        app['metrics_compactor'] = compactor = metrics.MetricCompactor(db)
+        if is_primary(app):
+            self.compactor = app.loop.create_task(compactor.run())
+            app['metrics_compaction'] = self.compactor
+
+    async def get(self):
+        if not self.is_admin():
+            return web.Response(text="{}", headers=self.headers)
+        status = await self.app['metrics_compactor'].status()
+        return web.Response(text=dump(status), headers=self.headers)
+
+    async def post(self):
+        raise web.HTTPMethodNotAllowed("POST", ["GET"])
+
+
 class MetaAPI(RESTCollection):
     async def get(self):
         apis = {}
@@ -184,19 +644,36 @@ class MetaAPI(RESTCollection):
                             headers=self.headers)
 
 
-async def register_api(app, api, base_uri):
-    router = app.router
-    db = app['db']
-    await api.bootstrap(app, db)
+async def bootstrap_api(app, api):
+    with stats.startup_phase("bootstrap:{}".format(type(api).__name__)):
+        await api.bootstrap(app, app['db'])
+
 
+# collection level routes sharing the item namespace; no item may take
+# these ids or requests for the routes with other methods would reach it
+RESERVED_IDS = ("changes", "export", "import")
+
+
+def register_api(app, api, base_uri):
+    router = app.router
     apiep = "/{}/{}/{}/".format(
             base_uri,
             api.version,
             api.endpoint)
+    feeds = app.setdefault('change_feeds', set())
+    if api.changes and apiep not in feeds:
+        feeds.add(apiep)
+        router.add_route("GET", apiep + "changes",
+                         api.handler("change_feed"))
     if isinstance(api, RESTCollection):
         route = router.add_resource(apiep)
+        router.add_route("GET", apiep + "export",
+                         api.handler("export_ndjson"))
+        router.add_route("POST", apiep + "import",
+                         api.handler("import_ndjson"))
     else:
-        itemep = "%s{uid:[\w_-]+/?}" % (apiep)
+        itemep = r"%s{uid:(?!(?:%s)/?$)[\w_-]+/?}" % (
+                apiep, "|".join(RESERVED_IDS))
         route = router.add_resource(itemep)
         # schema explicitly added for each item type
         router.add_route("*", "/{}/{}/schema/{}/".format(
@@ -211,5 +688,25 @@ async def register_api(app, api, base_uri):
 
 
 async def register_apis(app, base_uri="api"):
-    for api in [MetricsAPI(), LayersAPI(), LayerAPI(), RepoAPI()]:
-        await register_api(app, api, base_uri)
+    workers = getattr(app['options'], "ingest_workers", 2)
+    app['jobs'] = jobs.JobQueue(app, run_ingest_job, workers=workers)
+    apis = [MetricsAPI(), MetricsRollupAPI(), MetricsRetentionAPI(),
+            LayersAPI(), LayerAPI(), RepoAPI(), JobsAPI()]
+    # bootstraps are mostly index builds, let them overlap
+    await asyncio.gather(*[bootstrap_api(app, api) for api in apis],
+                         loop=app.loop)
+    # but keep route registration in a stable order
+    for api in apis:
+        register_api(app, api, base_uri)
+    app.router.add_route("GET", "/{}/v2/_stats".format(base_uri),
+                         StatsAPI().get)
+    await changes.hub.follow(
+            app.loop, app['db'],
+            sorted({api.factory.collection for api in apis if api.changes}),
+            jobs=(jobs.IngestJob.collection, Repo.collection))
+    app.on_shutdown.append(close_change_feeds)
+
+
+async def close_change_feeds(app):
+    # lets open SSE responses finish instead of waiting out shutdown
+    changes.hub.close()
@@ -0,0 +1,106 @@
+"""CPU bound parsing of ingested content, kept off the event loop
+
+YAML parsing and base64 decoding of repo files run in an executor so a
+sweep over large repos doesn't stall in-flight requests. The libyaml
+backed loader is used when PyYAML was built with it.
+"""
+import asyncio
+import base64
+import logging
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import yaml
+
+from . import stats
+
+log = logging.getLogger("layersite")
+
+YAMLLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+parse_duration = stats.registry.histogram(
+        "layersite_parse_duration_seconds",
+        "Time spent parsing ingested files, including executor queueing",
+        ("kind",))
+parse_skipped = stats.registry.counter(
+        "layersite_parse_skipped_total",
+        "Ingested files skipped by the size guard",
+        ("kind",))
+
+
+class ContentTooLarge(ValueError):
+    pass
+
+
+# Module level so they can be shipped to a process pool
+def load_yaml(text):
+    return yaml.load(text, Loader=YAMLLoader)
+
+
+def decode_base64(content):
+    return base64.b64decode(content).decode("utf-8")
+
+
+class Parser:
+    MAX_SIZE = 1024 * 1024
+    SLOW = 0.5
+
+    def __init__(self, executor=None, max_size=MAX_SIZE):
+        self.executor = executor
+        self.max_size = max_size
+
+    async def run(self, kind, fn, data, name=None, size=None):
+        size = len(data) if size is None else size
+        if self.max_size and size > self.max_size:
+            parse_skipped.inc(kind)
+            raise ContentTooLarge("{} is {} bytes, limit is {}".format(
+                name or kind, size, self.max_size))
+        loop = asyncio.get_event_loop()
+        start = time.perf_counter()
+        try:
+            return await loop.run_in_executor(self.executor, fn, data)
+        finally:
+            elapsed = time.perf_counter() - start
+            parse_duration.observe(elapsed, kind)
+            if elapsed > self.SLOW:
+                log.info("Parsing %s (%s, %d bytes) took %.2fs",
+                         name or "content", kind, size, elapsed)
+
+    async def yaml(self, text, name=None):
+        return await self.run("yaml", load_yaml, text, name)
+
+    async def base64(self, content, name=None):
+        # guard on the decoded size, base64 inflates by 4/3
+        return await self.run("base64", decode_base64, content, name,
+                              size=len(content) * 3 // 4)
+
+    async def run_blocking(self, fn, *args):
+        """Run blocking work that can't be pickled, on the pool if threaded
+
+        A process pool can't take bound methods or open files, so those
+        fall back to the loop's default thread pool.
+        """
+        executor = self.executor
+        if not isinstance(executor, ThreadPoolExecutor):
+            executor = None
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(executor, fn, *args)
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+
+
+parser = Parser()
+
+
+def configure(kind="thread", workers=2, max_size=Parser.MAX_SIZE):
+    """Replace the module parser with one using the requested executor"""
+    global parser
+    if kind == "process":
+        executor = ProcessPoolExecutor(max_workers=workers)
+    else:
+        executor = ThreadPoolExecutor(max_workers=workers)
+    parser.shutdown()
+    parser = Parser(executor, max_size)
+    return parser
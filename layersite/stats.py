@@ -0,0 +1,301 @@
+"""In process instrumentation exposed in the Prometheus text format
+
+Collectors are plain dicts keyed by label tuples so recording a sample is
+a dict lookup plus (for histograms) a bisect over the bucket bounds. This
+is cheap enough to leave enabled in production.
+
+With several worker processes each one periodically writes a snapshot
+of its registry to a shared directory, and whichever worker answers a
+scrape merges them, labelling every sample with its `worker`.
+"""
+import asyncio
+import bisect
+import json
+import logging
+import re
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+log = logging.getLogger("layersite")
+
+# Seconds, tuned for web requests and database calls
+DEFAULT_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5,
+                   1, 2.5, 5, 10, 30)
+
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace(
+                "\n", "\\n").replace('"', '\\"')
+        pairs.append('{}="{}"'.format(name, value))
+    return "{" + ",".join(pairs) + "}"
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class Collector:
+    kind = "untyped"
+
+    def __init__(self, name, doc, labels=()):
+        self.name = name
+        self.doc = doc
+        self.labels = tuple(labels)
+        self.values = {}
+
+    def render(self):
+        yield "# HELP {} {}".format(self.name, self.doc)
+        yield "# TYPE {} {}".format(self.name, self.kind)
+        for key in sorted(self.values, key=lambda k: tuple(map(str, k))):
+            yield from self.render_sample(key, self.values[key])
+
+    def render_sample(self, key, value):
+        yield "{}{} {}".format(self.name, format_labels(self.labels, key),
+                               format_value(value))
+
+    def snapshot(self):
+        return {"kind": self.kind, "doc": self.doc,
+                "labels": list(self.labels),
+                "values": [[list(k), v] for k, v in self.values.items()]}
+
+
+class Counter(Collector):
+    kind = "counter"
+
+    def inc(self, *labels, amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def get(self, *labels):
+        return self.values.get(labels, 0)
+
+
+class Gauge(Collector):
+    kind = "gauge"
+
+    def set(self, value, *labels):
+        self.values[labels] = value
+
+    def inc(self, *labels, amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self.values[labels] = self.values.get(labels, 0) - amount
+
+    def get(self, *labels):
+        return self.values.get(labels, 0)
+
+
+class Histogram(Collector):
+    kind = "histogram"
+
+    def __init__(self, name, doc, labels=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, doc, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labels):
+        sample = self.values.get(labels)
+        if sample is None:
+            # [per bucket counts..., +Inf count], sum
+            sample = self.values[labels] = [[0] * (len(self.buckets) + 1), 0]
+        sample[0][bisect.bisect_left(self.buckets, value)] += 1
+        sample[1] += value
+
+    @contextmanager
+    def time(self, *labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def count(self, *labels):
+        sample = self.values.get(labels)
+        return sum(sample[0]) if sample else 0
+
+    def snapshot(self):
+        data = super(Histogram, self).snapshot()
+        data["buckets"] = list(self.buckets)
+        return data
+
+    def render_sample(self, key, value):
+        counts, total = value
+        names = self.labels + ("le",)
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            yield "{}_bucket{} {}".format(
+                    self.name,
+                    format_labels(names, key + (format_value(bound),)),
+                    cumulative)
+        labels = format_labels(self.labels, key)
+        yield "{}_sum{} {}".format(self.name, labels, format_value(total))
+        yield "{}_count{} {}".format(self.name, labels, cumulative)
+
+
+class Registry:
+    def __init__(self):
+        self.collectors = {}
+
+    def register(self, collector):
+        existing = self.collectors.get(collector.name)
+        if existing is not None:
+            return existing
+        self.collectors[collector.name] = collector
+        return collector
+
+    def counter(self, name, doc, labels=()):
+        return self.register(Counter(name, doc, labels))
+
+    def gauge(self, name, doc, labels=()):
+        return self.register(Gauge(name, doc, labels))
+
+    def histogram(self, name, doc, labels=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, doc, labels, buckets))
+
+    def render(self):
+        lines = []
+        for name in sorted(self.collectors):
+            lines.extend(self.collectors[name].render())
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        return {name: collector.snapshot()
+                for name, collector in self.collectors.items()}
+
+
+registry = Registry()
+
+
+def merge_snapshots(snapshots):
+    """A registry holding every worker's samples under a worker label"""
+    merged = Registry()
+    for worker, snapshot in sorted(snapshots.items()):
+        for name, data in snapshot.items():
+            labels = ("worker",) + tuple(data["labels"])
+            if data["kind"] == "histogram":
+                collector = merged.histogram(name, data["doc"], labels,
+                                             data["buckets"])
+            elif data["kind"] == "gauge":
+                collector = merged.gauge(name, data["doc"], labels)
+            else:
+                collector = merged.counter(name, data["doc"], labels)
+            for key, value in data["values"]:
+                collector.values[(worker,) + tuple(key)] = value
+    return merged
+
+
+def snapshot_path(directory, worker):
+    return Path(directory) / "{}.json".format(worker)
+
+
+def write_snapshot(path, registry=registry):
+    path = Path(path)
+    tmp = path.with_suffix(".tmp")
+    tmp.write_text(json.dumps(registry.snapshot()))
+    # readers never see a partial file
+    tmp.replace(path)
+
+
+def read_snapshots(directory):
+    snapshots = {}
+    for path in Path(directory).glob("*.json"):
+        try:
+            snapshots[path.stem] = json.loads(path.read_text())
+        except (OSError, ValueError):
+            log.debug("Skipping unreadable stats snapshot %s", path)
+    return snapshots
+
+
+async def publish_snapshots(path, interval=5, registry=registry):
+    """Keep this worker's snapshot at most `interval` seconds old"""
+    while True:
+        write_snapshot(path, registry)
+        await asyncio.sleep(interval)
+
+http_duration = registry.histogram(
+        "layersite_http_request_duration_seconds",
+        "Time spent handling API requests",
+        ("api", "method", "status"))
+http_in_flight = registry.gauge(
+        "layersite_http_requests_in_flight",
+        "API requests currently being handled",
+        ("api",))
+mongo_duration = registry.histogram(
+        "layersite_mongo_operation_duration_seconds",
+        "Time spent in Mongo operations",
+        ("collection", "operation"))
+github_duration = registry.histogram(
+        "layersite_github_request_duration_seconds",
+        "Time spent in Github API calls",
+        ("endpoint", "status"))
+babel_duration = registry.histogram(
+        "layersite_babel_duration_seconds",
+        "Time spent transforming JSX with Babel",
+        buckets=(.1, .25, .5, 1, 2.5, 5, 10, 30))
+ingest_duration = registry.histogram(
+        "layersite_ingest_duration_seconds",
+        "Time spent ingesting a repo",
+        ("outcome",),
+        buckets=(.1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120))
+ingest_total = registry.counter(
+        "layersite_ingest_total",
+        "Repo ingests by outcome",
+        ("outcome",))
+loop_lag = registry.histogram(
+        "layersite_event_loop_lag_seconds",
+        "Delay between when a loop callback was due and when it ran",
+        buckets=(.001, .005, .01, .025, .05, .1, .25, .5, 1, 5))
+startup_seconds = registry.gauge(
+        "layersite_startup_seconds",
+        "Time spent in each phase of process startup",
+        ("phase",))
+
+_repo_path = re.compile(r"^/?repos/[^/]+/[^/]+(/[^/?]+)?")
+
+
+def github_endpoint(url):
+    """Reduce a Github API url to a low cardinality endpoint label"""
+    url = re.sub(r"^https?://[^/]+", "", url)
+    match = _repo_path.match(url)
+    if match:
+        return "/repos/:owner/:repo" + (match.group(1) or "")
+    return "/" + url.lstrip("/").split("?", 1)[0].split("/", 1)[0]
+
+
+@contextmanager
+def mongo_timer(collection, operation):
+    with mongo_duration.time(collection, operation):
+        yield
+
+
+@contextmanager
+def startup_phase(phase):
+    """Accumulate the time spent in a startup phase"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        startup_seconds.inc(phase, amount=time.perf_counter() - start)
+
+
+def startup_report():
+    return ", ".join("{} {:.3f}s".format(key[0], value) for key, value in
+                     sorted(startup_seconds.values.items()))
+
+
+async def monitor_loop_lag(loop, interval=0.5):
+    """Record how late the loop wakes us compared to when we asked"""
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        lag = loop.time() - start - interval
+        loop_lag.observe(max(lag, 0))
@@ -257,7 +257,8 @@ var RepoView = React.createClass({
     queryBackend: function() {
         var self = this;
         $.ajax({
-            url: "/api/v2/repos/" + this.props.id + "/",
+            url: "/api/v2/repos/" + this.props.id +
+                 "/?expand=readme,rules,schema",
             dataType: 'json',
             cache: false})
         .done(function(data) {
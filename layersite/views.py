@@ -1,5 +1,4 @@
 import logging
-import pkg_resources
 from pathlib import Path
 
 import aiohttp_jinja2
@@ -51,8 +50,7 @@ def configure_access(app, cred_conf):
 def setup_routes(app, options):
     router = app.router
     router.add_route("GET", "/", index)
-    transformer = BabelTransformer(pkg_resources.resource_filename(
-                                   __name__, 'templates'))
+    transformer = BabelTransformer(Path(__file__).parent / "templates")
     jsx = router.add_resource("/static/{filename:\w+\.jsx}")
     jsx.add_route("*", transformer.get)
 
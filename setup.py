@@ -13,7 +13,8 @@ setup(
     name='layersite',
     version="0.1.0",
     packages=find_packages(
-        exclude=["*.tests", "*.tests.*", "tests.*", "tests"]),
+        exclude=["*.tests", "*.tests.*", "tests.*", "tests",
+                 "benchmarks", "benchmarks.*"]),
     install_requires=[],
     include_package_data=True,
     maintainer='Benjamin Saller',
@@ -0,0 +1,71 @@
+import asyncio
+import unittest
+from unittest import mock
+
+from aiohttp import web
+from utils import LoopTestCase
+
+from layersite import admission
+
+
+class TestLimiter(LoopTestCase):
+    def test_queue_then_shed(self):
+        limiter = admission.Limiter("test", concurrency=1, queue=1, wait=1)
+
+        async def scenario():
+            await limiter.acquire()
+            waiting = self.loop.create_task(limiter.acquire())
+            await asyncio.sleep(0)
+            self.assertEqual(len(limiter.waiters), 1)
+            with self.assertRaises(web.HTTPServiceUnavailable) as e:
+                await limiter.acquire()
+            self.assertEqual(e.exception.headers["Retry-After"], "1")
+            # the slot passes straight to the waiter
+            limiter.release()
+            await waiting
+            self.assertEqual(limiter.active, 1)
+            limiter.release()
+            self.assertEqual(limiter.active, 0)
+        self.run_loop(scenario())
+
+    def test_wait_timeout(self):
+        limiter = admission.Limiter("test", concurrency=1, queue=4,
+                                    wait=0.01)
+
+        async def scenario():
+            await limiter.acquire()
+            with self.assertRaises(web.HTTPServiceUnavailable):
+                await limiter.acquire()
+            self.assertFalse(limiter.waiters)
+        self.run_loop(scenario())
+
+    def test_timeout_after_handover_returns_slot(self):
+        limiter = admission.Limiter("test", concurrency=1, queue=4, wait=1)
+
+        async def handed_then_timed_out(waiter, timeout):
+            limiter.release()
+            raise asyncio.TimeoutError()
+
+        async def scenario():
+            await limiter.acquire()
+            with mock.patch("asyncio.wait_for", handed_then_timed_out):
+                with self.assertRaises(web.HTTPServiceUnavailable):
+                    await limiter.acquire()
+            self.assertEqual(limiter.active, 0)
+        self.run_loop(scenario())
+
+
+class TestTokenBuckets(unittest.TestCase):
+    def test_refill(self):
+        buckets = admission.TokenBuckets(rate=1, burst=2)
+        self.assertEqual(buckets.take("a", now=0), 0)
+        self.assertEqual(buckets.take("a", now=0), 0)
+        self.assertAlmostEqual(buckets.take("a", now=0), 1)
+        self.assertEqual(buckets.take("b", now=0), 0)
+        self.assertEqual(buckets.take("a", now=1.5), 0)
+
+    def test_forgets_oldest_client(self):
+        buckets = admission.TokenBuckets(rate=1, burst=1, max_clients=2)
+        for key in "abc":
+            buckets.take(key, now=0)
+        self.assertEqual(list(buckets.buckets), ["b", "c"])
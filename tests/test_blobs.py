@@ -0,0 +1,46 @@
+from pymongo.errors import DuplicateKeyError
+from utils import LoopTestCase
+
+from benchmarks.fakemongo import FakeDatabase
+from layersite import blobs
+
+
+class TestBlobs(LoopTestCase):
+    def setUp(self):
+        super(TestBlobs, self).setUp()
+        self.db = FakeDatabase()
+
+    def test_content_hash_is_canonical(self):
+        self.assertEqual(blobs.content_hash({"a": 1, "b": [2]}),
+                         blobs.content_hash({"b": [2], "a": 1}))
+        self.assertNotEqual(blobs.content_hash("x"),
+                            blobs.content_hash("y"))
+
+    def test_externalize_and_expand(self):
+        data = {"readme": "# hello",
+                "rules": [{"path": "a.rules", "sha": "1",
+                           "content": [{"name": "r"}]}],
+                "schema": []}
+        refs = self.run_loop(blobs.externalize(self.db, data, {}))
+        self.assertNotIn("readme", refs)
+        self.assertEqual(refs["readme_blob"], blobs.content_hash("# hello"))
+        self.assertNotIn("content", refs["rules"][0])
+        self.assertEqual(len(self.db.blobs.docs), 2)
+
+        self.run_loop(blobs.expand(self.db, [refs], {"readme", "rules"}))
+        self.assertEqual(refs["readme"], "# hello")
+        self.assertEqual(refs["rules"][0]["content"], [{"name": "r"}])
+
+    def test_known_content_is_not_rewritten(self):
+        existing = {"readme_blob": blobs.content_hash("# hello")}
+        refs = self.run_loop(blobs.externalize(
+            self.db, {"readme": "# hello"}, existing))
+        self.assertEqual(refs["readme_blob"], existing["readme_blob"])
+        self.assertEqual(self.db.blobs.docs, [])
+
+    def test_concurrent_store(self):
+        async def lost_race(*args, **kwargs):
+            raise DuplicateKeyError("E11000")
+        self.db.blobs.update = lost_race
+        key = self.run_loop(blobs.Blob.store(self.db, "# hello", "readme"))
+        self.assertEqual(key, blobs.content_hash("# hello"))
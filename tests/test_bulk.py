@@ -0,0 +1,136 @@
+import base64
+import json
+from unittest import mock
+
+from aiohttp import web
+from aiohttp import test_utils
+from pymongo.errors import BulkWriteError
+from utils import LoopTestCase, O
+
+from benchmarks.fakemongo import FakeDatabase
+from layersite import model
+
+
+def user_headers(login):
+    user = json.dumps({"login": login}).encode("utf-8")
+    return {"Cookie": "u=" + base64.b64encode(user).decode("ascii")}
+
+
+def layer(oid, **kwargs):
+    doc = {"id": oid, "name": oid, "repo": "https://github.com/o/" + oid,
+           "owner": ["someone"]}
+    doc.update(kwargs)
+    return json.dumps(doc)
+
+
+class TestBulk(LoopTestCase):
+    def setUp(self):
+        super(TestBulk, self).setUp()
+        self.db = FakeDatabase()
+        app = web.Application(loop=self.loop)
+        app['db'] = self.db
+        app['admin_users'] = {"admin"}
+        app['options'] = O()
+        model.register_api(app, model.LayersAPI(), "api")
+        model.register_api(app, model.LayerAPI(), "api")
+        self.client = test_utils.TestClient(app)
+        self.run_loop(self.client.start_server())
+        self.admin = user_headers("admin")
+
+    def tearDown(self):
+        self.run_loop(self.client.close())
+        super(TestBulk, self).tearDown()
+
+    def request(self, method, path, **kwargs):
+        async def go():
+            response = await self.client.request(method, path, **kwargs)
+            return response.status, await response.text()
+        return self.run_loop(go())
+
+    def import_lines(self, *lines, headers=None):
+        status, body = self.request(
+                "POST", "/api/v2/layers/import",
+                data="\n".join(lines) + "\n",
+                headers=self.admin if headers is None else headers)
+        return status, json.loads(body) if status == 200 else body
+
+    def test_import(self):
+        status, result = self.import_lines(layer("a"), "{not json",
+                                           layer("b"), layer("c", name=3))
+        self.assertEqual(status, 200)
+        self.assertEqual(result["imported"], 2)
+        self.assertEqual(result["errors"], 2)
+        self.assertEqual([e["line"] for e in result["error_details"]],
+                         [2, 4])
+        stored = {d["id"]: d for d in self.db.layers.docs}
+        self.assertEqual(sorted(stored), ["a", "b"])
+        self.assertEqual(stored["a"]["version"], 1)
+
+    def test_import_bumps_version(self):
+        self.import_lines(layer("a"))
+        # an imported version is ignored rather than moving it backwards
+        self.import_lines(layer("a", summary="new", version=0))
+        stored = self.db.layers.docs[0]
+        self.assertEqual(stored["version"], 2)
+        self.assertEqual(stored["summary"], "new")
+
+    def test_import_write_errors(self):
+        bulk_write = self.db.layers.bulk_write
+
+        async def refuse_bad(requests, ordered=True):
+            # as Mongo does unordered: write the rest, then report
+            bad = [i for i, r in enumerate(requests)
+                   if r._filter["id"] == "bad"]
+            await bulk_write([r for i, r in enumerate(requests)
+                              if i not in bad], ordered=ordered)
+            if bad:
+                raise BulkWriteError({"writeErrors": [
+                    {"index": i, "code": 66, "errmsg": "immutable _id"}
+                    for i in bad]})
+        self.db.layers.bulk_write = refuse_bad
+        with mock.patch.object(model.LayersAPI, "IMPORT_BATCH", 2):
+            status, result = self.import_lines(
+                    layer("a"), layer("bad"), "", layer("b"), layer("bad"),
+                    layer("c"))
+        self.assertEqual(status, 200)
+        self.assertEqual(result["imported"], 3)
+        self.assertEqual(result["batches"], 3)
+        self.assertEqual(result["errors"], 2)
+        self.assertEqual(result["error_details"],
+                         [{"line": 2, "error": "immutable _id"},
+                          {"line": 5, "error": "immutable _id"}])
+        self.assertEqual(sorted(d["id"] for d in self.db.layers.docs),
+                         ["a", "b", "c"])
+
+    def test_import_requires_admin(self):
+        status, _ = self.import_lines(layer("a"),
+                                      headers=user_headers("someone"))
+        self.assertEqual(status, 401)
+        self.assertEqual(self.db.layers.docs, [])
+
+    def test_export(self):
+        self.import_lines(layer("a"), layer("b"))
+        status, body = self.request("GET", "/api/v2/layers/export",
+                                    headers=self.admin)
+        self.assertEqual(status, 200)
+        exported = [json.loads(line) for line in body.splitlines()]
+        self.assertEqual(sorted(d["id"] for d in exported), ["a", "b"])
+        self.assertNotIn("_id", exported[0])
+
+    def test_patch_fixed_fields(self):
+        self.import_lines(layer("a"))
+        for field in ("_id", "id", "version", "lastmodified"):
+            status, _ = self.request("PATCH", "/api/v2/layers/a/",
+                                     data=json.dumps({field: 1}),
+                                     headers=self.admin)
+            self.assertEqual(status, 400, field)
+        self.assertEqual(self.db.layers.docs[0]["version"], 1)
+
+    def test_reserved_ids(self):
+        for method, name in (("POST", "export"), ("DELETE", "export"),
+                             ("GET", "import"), ("DELETE", "import"),
+                             ("POST", "changes")):
+            status, _ = self.request(method, "/api/v2/layers/" + name,
+                                     data=layer(name), headers=self.admin)
+            self.assertEqual(status, 405, (method, name))
+        self.assertEqual(self.db.layers.docs, [])
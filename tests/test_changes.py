@@ -0,0 +1,57 @@
+import json
+
+from utils import LoopTestCase
+
+from layersite import changes
+
+
+class TestChangeHub(LoopTestCase):
+    def setUp(self):
+        super(TestChangeHub, self).setUp()
+        self.hub = changes.ChangeHub(buffer=2)
+
+    def tearDown(self):
+        self.hub.close()
+        super(TestChangeHub, self).tearDown()
+
+    def test_fan_out_by_collection(self):
+        layers = self.hub.subscribe("layers")
+        repos = self.hub.subscribe("repos")
+        self.hub.publish("layers", "a", changes.SAVE)
+        event = layers.queue.get_nowait()
+        self.assertEqual((event["id"], event["kind"]), ("a", "save"))
+        self.assertTrue(repos.queue.empty())
+
+    def test_slow_consumer_is_evicted(self):
+        sub = self.hub.subscribe("layers")
+        for oid in "abc":
+            self.hub.publish("layers", oid, changes.SAVE)
+        self.assertTrue(sub.evicted)
+        self.assertNotIn(sub, self.hub.subscribers)
+        self.assertIsNone(sub.queue.get_nowait())
+
+    def test_streaming_ignores_local_publish(self):
+        sub = self.hub.subscribe("layers")
+        self.hub.streaming = True
+        self.hub.publish("layers", "a", changes.SAVE)
+        self.assertTrue(sub.queue.empty())
+        # except removes, which change streams can't attribute
+        self.hub.publish("layers", "a", changes.REMOVE)
+        self.assertEqual(sub.queue.get_nowait()["kind"], "remove")
+
+    def test_format_event(self):
+        self.hub.subscribe("layers")
+        self.hub.publish("layers", "a", changes.REMOVE)
+        event = next(iter(self.hub.subscribers)).queue.get_nowait()
+        lines = changes.format_event(event).decode("utf-8").splitlines()
+        self.assertEqual(lines[1], "event: remove")
+        self.assertEqual(json.loads(lines[2][len("data: "):])["id"], "a")
+
+    def test_document_change(self):
+        change = {"operationType": "update", "documentKey": {"_id": 1},
+                  "fullDocument": {"id": "a"}}
+        self.assertEqual(changes.ChangeHub.document_change("layers", change),
+                         ("layers", "a", changes.SAVE))
+        change = {"operationType": "delete", "documentKey": {"_id": 1}}
+        self.assertIsNone(changes.ChangeHub.document_change("layers",
+                                                            change))
@@ -0,0 +1,56 @@
+import unittest
+
+import jsonschema
+
+from layersite import document
+
+
+class Thing(document.Document):
+    collection = "things"
+    pk = "id"
+    schema = {"type": "object",
+              "properties": {"id": {"type": "string"},
+                             "name": {"type": "string"},
+                             "sha": {"type": "string",
+                                     "pattern": "^[0-9a-f]*$"},
+                             "meta": {"type": "object",
+                                      "properties": {
+                                          "stars": {"type": "number"}}},
+                             "version": {"type": "number", "default": 1}},
+              "required": ["id", "name"]}
+
+
+class TestMergePatch(unittest.TestCase):
+    def test_paths(self):
+        sets, unsets = document.merge_patch_paths(
+                {"name": "x", "meta": {"stars": 3, "old": None},
+                 "summary": None})
+        self.assertEqual(sets, {"name": "x", "meta.stars": 3})
+        self.assertEqual(sorted(unsets), ["meta.old", "summary"])
+
+    def test_object_replaces_scalar(self):
+        sets, unsets = document.merge_patch_paths(
+                {"name": {"a": 1}, "meta": {"stars": 3}}, Thing.schema)
+        self.assertEqual(sets, {"name": {"a": 1}, "meta.stars": 3})
+        self.assertRaises(jsonschema.ValidationError,
+                          Thing.validate_paths, sets)
+
+    def test_invalid_keys(self):
+        self.assertRaises(ValueError, document.merge_patch_paths,
+                          {"$where": 1})
+        self.assertRaises(ValueError, document.merge_patch_paths,
+                          {"a.b": 1})
+
+    def test_validate_paths(self):
+        Thing.validate_paths({"meta.stars": 3, "unknown": "ok"})
+        self.assertRaises(jsonschema.ValidationError,
+                          Thing.validate_paths, {"meta.stars": "many"})
+        self.assertRaises(ValueError, Thing.validate_paths, {}, ["name"])
+
+    def test_text_fields_skip_identifiers(self):
+        self.assertEqual(sorted(Thing.text_fields()), ["id", "name"])
+
+    def test_update_spec_bumps_version(self):
+        spec = Thing({"id": "a", "name": "b", "version": 4}).update_spec()
+        self.assertNotIn("version", spec["$set"])
+        self.assertEqual(spec["$inc"], {"version": 1})
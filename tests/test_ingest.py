@@ -0,0 +1,80 @@
+import functools
+import tarfile
+
+from utils import LoopTestCase
+
+from benchmarks import fakegithub
+from layersite import auth
+from layersite import model
+
+
+class TestSnapshotIngest(LoopTestCase):
+    repo_url = "https://github.com/owner/layer-test"
+
+    def setUp(self):
+        super(TestSnapshotIngest, self).setUp()
+        self.github = fakegithub.FakeGithub(self.loop)
+        self.github.add_repo("owner", "layer-test")
+        self.endpoint = auth.GithubAPI.endpoint
+        auth.GithubAPI.endpoint = self.run_loop(self.github.start())
+        self.gh = auth.GithubAPI()
+        self.api = model.RepoAPI()
+
+    def tearDown(self):
+        self.gh.close()
+        auth.GithubAPI.endpoint = self.endpoint
+        self.run_loop(self.github.stop())
+        super(TestSnapshotIngest, self).tearDown()
+
+    def paths(self, snapshot):
+        return sorted((item["path"], item["sha"])
+                      for item in snapshot["rules"] + snapshot["schema"])
+
+    def test_git_blob_sha(self):
+        self.assertEqual(model.RepoAPI.git_blob_sha(b"pass\n"),
+                         fakegithub.sha("pass\n"))
+
+    def test_walk_tree(self):
+        snapshot = self.run_loop(self.api.walk_tree(self.repo_url, self.gh,
+                                                    {}))
+        repo = self.github.repos[("owner", "layer-test")]
+        self.assertEqual(snapshot["readme"], repo.files["README.md"])
+        self.assertEqual(snapshot["readme_sha"],
+                         fakegithub.sha(repo.files["README.md"]))
+        self.assertEqual(len(snapshot["rules"]), 2)
+        self.assertEqual(len(snapshot["schema"]), 3)
+        self.assertEqual(snapshot["schema"][0]["content"]["type"], "object")
+        # the tree, the readme and one blob per rules and schema file
+        self.assertEqual(self.github.requests, 1 + 1 + 5)
+
+    def test_walk_tree_reuses_unchanged(self):
+        first = self.run_loop(self.api.walk_tree(self.repo_url, self.gh, {}))
+        existing = dict(first, readme_blob="0" * 64)
+        del existing["readme"]
+        self.github.requests = 0
+        second = self.run_loop(self.api.walk_tree(self.repo_url, self.gh,
+                                                  existing))
+        # only the tree is fetched, everything else matched its sha
+        self.assertEqual(self.github.requests, 1)
+        self.assertIsNone(second["readme"])
+        self.assertEqual(second["readme_blob"], "0" * 64)
+        self.assertEqual(self.paths(second), self.paths(first))
+
+    def test_walk_tarball(self):
+        tree = self.run_loop(self.api.walk_tree(self.repo_url, self.gh, {}))
+        # small chunks so the pipe fills and the download waits on it
+        self.gh.stream = functools.partial(self.gh.stream, chunk_size=256)
+        snapshot = self.run_loop(self.api.walk_tarball(self.repo_url,
+                                                       self.gh))
+        self.assertEqual(snapshot["readme"], tree["readme"])
+        self.assertEqual(snapshot["readme_sha"], tree["readme_sha"])
+        self.assertEqual(self.paths(snapshot), self.paths(tree))
+
+    def test_walk_tarball_bad_archive(self):
+        class Garbage:
+            async def stream(self, url, sink):
+                for i in range(1000):
+                    await sink(b"not a tarball" * 100)
+
+        with self.assertRaises(tarfile.ReadError):
+            self.run_loop(self.api.walk_tarball(self.repo_url, Garbage()))
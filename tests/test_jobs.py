@@ -0,0 +1,135 @@
+import asyncio
+import datetime
+
+from pymongo.errors import AutoReconnect
+from utils import LoopTestCase, O
+
+from benchmarks.fakemongo import FakeDatabase
+from layersite import jobs
+
+
+class TestJobQueue(LoopTestCase):
+    def setUp(self):
+        super(TestJobQueue, self).setUp()
+        self.db = FakeDatabase()
+        self.queue = jobs.JobQueue(O(db=self.db, loop=self.loop),
+                                   handler=None)
+
+    def stored(self, job):
+        return self.run_loop(self.queue.collection.find_one({"id": job["id"]}))
+
+    def test_enqueue_coalesces(self):
+        first = self.run_loop(self.queue.enqueue("a", reason="sweep"))
+        second = self.run_loop(self.queue.enqueue("a", reason="update"))
+        other = self.run_loop(self.queue.enqueue("b"))
+        self.assertEqual(first["id"], second["id"])
+        self.assertEqual(second["reason"], "sweep")
+        self.assertNotEqual(first["id"], other["id"])
+        self.assertEqual(len(self.db.jobs.docs), 2)
+
+    def test_claim_clears_key(self):
+        pending = self.run_loop(self.queue.enqueue("a"))
+        job = self.run_loop(self.queue.claim())
+        self.assertEqual(job["id"], pending["id"])
+        self.assertEqual(job["state"], jobs.RUNNING)
+        self.assertEqual(job["attempts"], 1)
+        self.assertNotIn("key", job)
+        self.assertIsNone(self.run_loop(self.queue.claim()))
+        # an edit while it runs queues a fresh job
+        fresh = self.run_loop(self.queue.enqueue("a"))
+        self.assertNotEqual(fresh["id"], job["id"])
+
+    def test_fail_backs_off(self):
+        self.run_loop(self.queue.enqueue("a"))
+        job = self.run_loop(self.queue.claim())
+        before = datetime.datetime.utcnow()
+        self.run_loop(self.queue.fail(job, "IOError: boom"))
+        stored = self.stored(job)
+        self.assertEqual(stored["state"], jobs.PENDING)
+        self.assertEqual(stored["key"], "a")
+        self.assertEqual(stored["last_error"], "IOError: boom")
+        self.assertNotIn("lease_expires", stored)
+        self.assertGreaterEqual(
+                stored["not_before"],
+                before + datetime.timedelta(seconds=self.queue.BACKOFF))
+        # not runnable again until the backoff passes
+        self.assertIsNone(self.run_loop(self.queue.claim()))
+        self.assertEqual(self.queue.backoff(3), 4 * self.queue.BACKOFF)
+        self.assertEqual(self.queue.backoff(30), self.queue.MAX_BACKOFF)
+
+    def test_max_attempts_fails(self):
+        self.run_loop(self.queue.enqueue("a"))
+        job = self.run_loop(self.queue.claim())
+        job["attempts"] = self.queue.MAX_ATTEMPTS
+        self.run_loop(self.queue.fail(job, "IOError: boom"))
+        stored = self.stored(job)
+        self.assertEqual(stored["state"], jobs.FAILED)
+        self.assertIn("finished", stored)
+        self.assertNotIn("key", stored)
+        self.assertEqual(self.run_loop(self.queue.status())[jobs.FAILED], 1)
+
+    def test_run_finishes(self):
+        seen = []
+
+        async def handler(app, job):
+            seen.append(job["layer"])
+        self.queue.handler = handler
+        self.run_loop(self.queue.enqueue("a"))
+        job = self.run_loop(self.queue.claim())
+        self.run_loop(self.queue.run(job))
+        self.assertEqual(seen, ["a"])
+        self.assertEqual(self.stored(job)["state"], jobs.DONE)
+
+    def test_consumer_survives_outcome_errors(self):
+        seen = []
+        finish = self.queue.finish
+
+        async def handler(app, job):
+            seen.append(job["layer"])
+
+        async def flaky_finish(job):
+            if len(seen) == 1:
+                raise AutoReconnect("primary stepped down")
+            await finish(job)
+        self.queue.handler = handler
+        self.queue.finish = flaky_finish
+        self.run_loop(self.queue.enqueue("a"))
+        self.run_loop(self.queue.enqueue("b"))
+
+        async def scenario():
+            consumer = self.loop.create_task(self.queue.consume())
+            while len(seen) < 2:
+                await asyncio.sleep(0)
+            consumer.cancel()
+            await asyncio.gather(consumer, return_exceptions=True)
+        with self.assertLogs("layersite", "ERROR"):
+            self.run_loop(asyncio.wait_for(scenario(), 1))
+        self.assertEqual(seen, ["a", "b"])
+        states = sorted(d["state"] for d in self.db.jobs.docs)
+        self.assertEqual(states, [jobs.DONE, jobs.RUNNING])
+
+    def test_renew_retries(self):
+        self.queue.LEASE = 0.03
+        self.queue.RENEW_RETRY = 0
+        self.run_loop(self.queue.enqueue("a"))
+        job = self.run_loop(self.queue.claim())
+        update = self.queue.collection.update
+        calls = []
+
+        async def flaky_update(*args, **kwargs):
+            calls.append(args)
+            if len(calls) == 1:
+                raise AutoReconnect("primary stepped down")
+            await update(*args, **kwargs)
+        self.queue.collection.update = flaky_update
+
+        async def scenario():
+            renewer = self.loop.create_task(self.queue.renew(job))
+            while len(calls) < 2:
+                await asyncio.sleep(0.001)
+            renewer.cancel()
+            await asyncio.gather(renewer, return_exceptions=True)
+        with self.assertLogs("layersite", "ERROR"):
+            self.run_loop(asyncio.wait_for(scenario(), 1))
+        self.assertGreater(self.stored(job)["lease_expires"],
+                           job["lease_expires"])
@@ -0,0 +1,135 @@
+import datetime
+import unittest
+
+from utils import LoopTestCase
+
+from benchmarks.fakemongo import FakeDatabase
+from layersite import jobs
+from layersite import metrics
+
+
+class TestRollupBuckets(unittest.TestCase):
+    def test_bucket_start(self):
+        when = datetime.datetime(2016, 6, 14, 13, 42, 7, 1234)
+        self.assertEqual(metrics.bucket_start(when, metrics.HOUR),
+                         datetime.datetime(2016, 6, 14, 13))
+        self.assertEqual(metrics.bucket_start(when, metrics.DAY),
+                         datetime.datetime(2016, 6, 14))
+        self.assertRaises(ValueError, metrics.bucket_start, when, "week")
+
+    def test_counter_key(self):
+        key = metrics.counter_key("$user.name")
+        self.assertNotIn(".", key)
+        self.assertFalse(key.startswith("$"))
+        self.assertEqual(metrics.counter_value(key), "$user.name")
+        self.assertEqual(metrics.counter_key(None), "-")
+
+
+class TestRollupQueries(LoopTestCase):
+    def setUp(self):
+        super(TestRollupQueries, self).setUp()
+        self.db = FakeDatabase()
+        self.when = datetime.datetime(2016, 6, 14, 13, 30)
+        for item, username in (("a", "u1"), ("a", "u2"), ("b", "u2")):
+            self.run_loop(metrics.MetricRollup.record(
+                self.db, {"kind": "layer", "action": "update",
+                          "item": item, "username": username},
+                when=self.when))
+        self.range = (metrics.HOUR, datetime.datetime(2016, 6, 14, 13),
+                      datetime.datetime(2016, 6, 14, 14))
+
+    def test_series(self):
+        series = metrics.MetricRollup.series
+        counts = [self.run_loop(series(self.db, *self.range, **kw))[0]
+                  ["count"] for kw in ({}, {"item": "a"},
+                                       {"username": "u2"})]
+        self.assertEqual(counts, [3, 2, 2])
+        with self.assertRaises(ValueError):
+            self.run_loop(series(self.db, *self.range,
+                                 item="a", username="u2"))
+
+    def test_top(self):
+        top = metrics.MetricRollup.top
+        ranked = self.run_loop(top(self.db, "item", *self.range, limit=1))
+        self.assertEqual(ranked, [{"item": "a", "count": 2}])
+        for limit in (0, -1):
+            with self.assertRaises(ValueError):
+                self.run_loop(top(self.db, "item", *self.range,
+                                  limit=limit))
+
+
+class TestPrepare(LoopTestCase):
+    def test_text_index(self):
+        db = FakeDatabase()
+        for factory in (metrics.Metric, jobs.IngestJob):
+            names = []
+
+            async def ensure_index(*args, **kwargs):
+                names.append(kwargs.get("name"))
+            getattr(db, factory.collection).ensure_index = ensure_index
+            self.run_loop(factory.prepare(db))
+            self.assertIn("fts", names, factory.__name__)
+
+
+class TestCompactor(LoopTestCase):
+    def setUp(self):
+        super(TestCompactor, self).setUp()
+        self.db = FakeDatabase()
+        self.compactor = metrics.MetricCompactor(self.db)
+        self.today = metrics.bucket_start(datetime.datetime.utcnow(),
+                                          metrics.DAY)
+
+    def event(self, when, item="a", username="u1"):
+        self.run_loop(self.db.metrics.insert(
+            {"kind": "layer", "action": "update", "item": item,
+             "username": username, "timestamp": when}))
+
+    def summaries(self):
+        return sorted((d["day"], d["item"], d["count"], d["unique_users"])
+                      for d in self.db.metrics_summary.docs)
+
+    def test_migrate_timestamps(self):
+        self.event("2016-06-14T13:42:07Z")
+        self.event("not a date")
+        self.event(datetime.datetime(2016, 6, 15))
+        self.compactor.MIGRATE_BATCH = 1
+        self.assertEqual(self.run_loop(self.compactor.migrate_timestamps()),
+                         2)
+        stamps = [d["timestamp"] for d in self.db.metrics.docs]
+        self.assertEqual(stamps[0], datetime.datetime(2016, 6, 14, 13, 42, 7))
+        self.assertTrue(all(isinstance(s, datetime.datetime)
+                            for s in stamps))
+
+    def test_compact_day_is_idempotent(self):
+        day = datetime.datetime(2016, 6, 14)
+        self.event(day + datetime.timedelta(hours=1))
+        self.event(day + datetime.timedelta(hours=2), username="u2")
+        self.event(day + datetime.timedelta(hours=3), item="b")
+        self.event(day + datetime.timedelta(days=1))
+        self.assertEqual(self.run_loop(self.compactor.compact_day(day)), 3)
+        first = self.summaries()
+        self.assertEqual(first, [(day, "a", 2, 2), (day, "b", 1, 1)])
+        self.run_loop(self.compactor.compact_day(day))
+        self.assertEqual(self.summaries(), first)
+
+    def test_resumes_from_watermark(self):
+        old = self.today - metrics.Metric.compact_after - \
+            datetime.timedelta(days=3)
+        self.event(old)
+        self.event(old + datetime.timedelta(days=1, hours=1), item="b")
+        # as if a previous run stopped after the first day
+        resume = old + datetime.timedelta(days=1)
+        self.run_loop(self.compactor.set_state(watermark=resume))
+        self.run_loop(self.compactor.compact())
+        self.assertEqual(self.summaries(), [(resume, "b", 1, 1)])
+        state = self.run_loop(self.compactor.state())
+        self.assertEqual(state["watermark"],
+                         self.today - metrics.Metric.compact_after)
+        self.assertEqual(state["last_days"], 2)
+        self.assertEqual(state["events_total"], 1)
+
+        # nothing left before the cutoff
+        self.run_loop(self.compactor.compact())
+        state = self.run_loop(self.compactor.state())
+        self.assertEqual(state["last_days"], 0)
+        self.assertEqual(state["events_total"], 1)
@@ -0,0 +1,40 @@
+import base64
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from utils import LoopTestCase
+
+from layersite import parsing
+
+
+class TestParser(LoopTestCase):
+    def setUp(self):
+        super(TestParser, self).setUp()
+        # a local parser, leaving the module one intact for other tests
+        self.parser = parsing.Parser(ThreadPoolExecutor(1), max_size=64)
+
+    def tearDown(self):
+        self.parser.shutdown()
+        super(TestParser, self).tearDown()
+
+    def test_yaml(self):
+        result = self.run_loop(self.parser.yaml("a: [1, 2]\n"))
+        self.assertEqual(result, {"a": [1, 2]})
+
+    def test_base64(self):
+        content = base64.b64encode(b"hello").decode("ascii")
+        self.assertEqual(self.run_loop(self.parser.base64(content)), "hello")
+
+    def test_size_guard(self):
+        with self.assertRaises(parsing.ContentTooLarge):
+            self.run_loop(self.parser.yaml("x" * 100, "big.rules"))
+
+    def test_safe_loader(self):
+        with self.assertRaises(Exception):
+            self.run_loop(self.parser.yaml(
+                "!!python/object/apply:os.getcwd []"))
+
+    def test_run_blocking_uses_pool(self):
+        name = self.run_loop(self.parser.run_blocking(
+            lambda: threading.current_thread().name))
+        self.assertNotEqual(name, threading.current_thread().name)
@@ -0,0 +1,55 @@
+import json
+import unittest
+
+from layersite import stats
+
+
+class TestStats(unittest.TestCase):
+    def setUp(self):
+        self.registry = stats.Registry()
+
+    def test_histogram_render(self):
+        h = self.registry.histogram("req_seconds", "Requests",
+                                    ("api",), buckets=(.1, 1))
+        h.observe(.05, "layers")
+        h.observe(.5, "layers")
+        h.observe(5, "layers")
+        text = self.registry.render()
+        self.assertIn('req_seconds_bucket{api="layers",le="0.1"} 1', text)
+        self.assertIn('req_seconds_bucket{api="layers",le="1"} 2', text)
+        self.assertIn('req_seconds_bucket{api="layers",le="+Inf"} 3', text)
+        self.assertIn('req_seconds_count{api="layers"} 3', text)
+        self.assertIn("# TYPE req_seconds histogram", text)
+
+    def test_counter_and_gauge(self):
+        c = self.registry.counter("ingests", "Ingests", ("outcome",))
+        c.inc("success")
+        c.inc("success")
+        g = self.registry.gauge("in_flight", "In flight")
+        g.inc()
+        g.dec()
+        text = self.registry.render()
+        self.assertIn('ingests{outcome="success"} 2', text)
+        self.assertIn('in_flight 0', text)
+        # registering again returns the existing collector
+        self.assertIs(self.registry.counter("ingests", "Ingests"), c)
+
+    def test_merge_snapshots(self):
+        c = self.registry.counter("ingests", "Ingests", ("outcome",))
+        c.inc("success")
+        h = self.registry.histogram("req_seconds", "Requests",
+                                    buckets=(.1, 1))
+        h.observe(.5)
+        snapshot = json.loads(json.dumps(self.registry.snapshot()))
+        text = stats.merge_snapshots({"0": snapshot, "1": snapshot}).render()
+        self.assertIn('ingests{worker="0",outcome="success"} 1', text)
+        self.assertIn('ingests{worker="1",outcome="success"} 1', text)
+        self.assertIn('req_seconds_bucket{worker="1",le="1"} 1', text)
+        self.assertEqual(text.count("# TYPE ingests counter"), 1)
+
+    def test_github_endpoint(self):
+        self.assertEqual(
+            stats.github_endpoint(
+                "https://api.github.com/repos/juju/layer/contents/x.rules"),
+            "/repos/:owner/:repo/contents")
+        self.assertEqual(stats.github_endpoint("/user"), "/user")
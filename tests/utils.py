@@ -1,6 +1,8 @@
 from contextlib import contextmanager
+import asyncio
 import pkg_resources
 import os
+import unittest
 
 
 def local_stream(name):
@@ -26,6 +28,24 @@ def Environ(**kwargs):
             os.environ[r] = orig[r]
 
 
+class LoopTestCase(unittest.TestCase):
+    """Runs each test with its own event loop as the current loop"""
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+        # later tests asking for the default loop must get a fresh one,
+        # not this closed loop or an error
+        asyncio.set_event_loop(None)
+        asyncio.set_event_loop_policy(None)
+
+    def run_loop(self, coro):
+        return self.loop.run_until_complete(coro)
+
+
 class O(dict):
     def __getattr__(self, key):
         return self[key]